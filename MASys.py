@@ -1,19 +1,164 @@
+import collections
+import heapq
+import itertools
 import operator
-import queue
+import pickle
 import random
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
 from operator import attrgetter, methodcaller
 from typing import List, Optional, Tuple
 
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from allocationPlan import AllocationPlan
 from senseArea import SenseArea, Region
 from senseMap import SenseMap
+from spatialIndex import RobotGrid
 from task import Task, TimeSlot, TimeCycle
-from robot import Robot, RobotCategory
+from robot import Robot, RobotCategory, feasibilityMask
 from message import Message, FeedBack
 from resultDisplay import pltMASys, pltSenseMap
 
 
+def deltaUtility(thetas, lambdas, planned_distance, task_distance, acquire):
+    """
+    ΔU = f1 - f2 + f3，参数可以是数值或numpy数组，运算顺序与逐个计算时相同
+    :param planned_distance: 机器人已规划的移动距离
+    :param task_distance: 机器人到目标区域并完成感知的移动距离
+    :param acquire: 目标感知点的acquireFunction值
+    """
+    f1 = thetas[0] * 1 / lambdas[0]
+    f2 = thetas[1] * (planned_distance + task_distance) / lambdas[1]
+    f3 = thetas[2] * acquire / lambdas[2]
+    return f1 - f2 + f3
+
+
+AllocationReport = collections.namedtuple("AllocationReport", "finished steps unallocated")
+AllocationReport.__doc__ = """
+allocationTasks的结果
+    finished:    分配是否已经完成，未完成时再次调用allocationTasks会从中断处继续
+    steps:       本次调用完成的分配次数
+    unallocated: 尚未分配的采样次数
+"""
+
+
+# 进程池中候选方案评估、bundle构建所需的只读状态，由_initSweep在每个进程中设置一次
+_sweep_state = None
+
+
+def _initSweep(state):
+    global _sweep_state
+    _sweep_state = state
+
+
+def _sweepRobot(job):
+    """
+    在进程池中评估一个机器人的全部候选子任务
+    :param job: (机器人快照, 候选子任务在subtasks中的下标)
+    :return: [(子任务下标, 完成时间, 传感器在robot.C.sensors中的下标, ΔU)]
+    """
+    robot, indices = job
+    subtasks, acquire, tables, time_cycle, thetas, lambdas = _sweep_state
+    inter_d, intra_d = tables[robot.C.id]
+    last_reg = robot.planned_path[-1].id
+
+    result = []
+    for i in indices:
+        task, reg = subtasks[i]
+        finish_time, select_sensor = min(robot.possiblePlan(reg, task))
+        if finish_time not in task.timeRange or not select_sensor:
+            continue
+        ts = time_cycle.slotIndex(finish_time)
+        u = deltaUtility(thetas, lambdas, robot.planned_distance[-1],
+                         inter_d[last_reg, reg.id] + intra_d[reg.id], acquire[reg.id, ts, robot.C.id])
+        result.append((i, finish_time, robot.C.sensors.index(select_sensor), float(u)))
+    return result
+
+
+def bundleBids(state, job):
+    """
+    CBBA的bundle构建：在机器人快照上依次追加ΔU最大、且能胜过当前中标者的子任务
+    :param state: (子任务, acquireFunction数组, 距离表, TimeCycle, THETAS, LAMBDAS, bundle上限)
+    :param job: (pickle后的机器人, 机器人序号, 候选子任务下标, 保留的bundle, 需要胜过的bid, 评估缓存)
+                保留的bundle为上一轮仍中标的[(子任务下标, 传感器在robot.C.sensors中的下标, bid)]，
+                需要胜过的bid为{子任务下标: (bid, -机器人序号)}，只包含已满员的子任务，
+                评估缓存为上一次构建时bundle每个位置的(选中的(子任务下标, 传感器下标), 候选评估)，
+                bundle的前缀与上一次相同时，该位置的候选评估仍然有效，不需要重新计算
+    :return: (新的bundle [(子任务下标, 传感器下标, bid)], 新的评估缓存)
+    """
+    subtasks, acquire, tables, time_cycle, thetas, lambdas, bundle_size = state
+    blob, j, candidates, kept, outbid, cache = job
+
+    # 保留的bundle是上一次bundle的前缀，bid保持不变
+    bundle = list(kept)
+    new_cache = cache[:len(kept)]
+    same = True
+    robot: Optional[Robot] = None
+    replayed = 0
+    while bundle_size is None or len(bundle) < bundle_size:
+        k = len(bundle)
+        if same and k < len(cache):
+            scores = cache[k][1]
+        else:
+            if robot is None:
+                robot = pickle.loads(blob)
+            # 在快照上重放bundle[:k]，之后计算每个候选子任务的ΔU
+            for i, sensor_index, _ in bundle[replayed:]:
+                task, reg = subtasks[i]
+                robot.assignTask(reg, task, robot.C.sensors[sensor_index])
+            replayed = k
+            scores = bundleScores(state, robot, candidates, {i for i, _, _ in bundle})
+
+        best = None
+        for i, u, sensor_index in scores:
+            # bid不超过bundle中前一个bid，使bid沿bundle单调不增，保证竞标收敛
+            bid = min(u, bundle[-1][2]) if bundle else u
+            if i in outbid and (bid, -j) <= outbid[i]:
+                continue
+            # bid相同时取ΔU大者，再相同时取先出现的候选
+            if best is None or (bid, u) > best[2:]:
+                best = (i, sensor_index, bid, u)
+        if best is None:
+            new_cache.append((None, scores))
+            break
+        i, sensor_index, bid, _ = best
+        same = same and k < len(cache) and cache[k][0] == (i, sensor_index)
+        new_cache.append(((i, sensor_index), scores))
+        bundle.append((i, sensor_index, bid))
+    return bundle, new_cache
+
+
+def bundleScores(state, robot: Robot, candidates, taken):
+    """
+    机器人在当前计划末尾追加每个候选子任务的ΔU
+    :return: [(子任务下标, ΔU, 传感器在robot.C.sensors中的下标)]，按候选子任务的顺序排列，不包含无法完成的子任务
+    """
+    subtasks, acquire, tables, time_cycle, thetas, lambdas, _ = state
+    inter_d, intra_d = tables[robot.C.id]
+    last_reg = robot.planned_path[-1].id
+    scores = []
+    for i in candidates:
+        if i in taken:
+            continue
+        task, reg = subtasks[i]
+        finish_time, select_sensor = min(robot.possiblePlan(reg, task))
+        if finish_time not in task.timeRange or not select_sensor:
+            continue
+        ts = time_cycle.slotIndex(finish_time)
+        u = float(deltaUtility(thetas, lambdas, robot.planned_distance[-1],
+                               inter_d[last_reg, reg.id] + intra_d[reg.id], acquire[reg.id, ts, robot.C.id]))
+        scores.append((i, u, robot.C.sensors.index(select_sensor)))
+    return scores
+
+
+def _bidRobot(job):
+    return bundleBids(_sweep_state, job)
+
+
 class MACrowdSystem:
 
     def __init__(self,
@@ -27,13 +172,25 @@ class MACrowdSystem:
                  repair_k=1,
                  info_save=False,
                  map_file=None,
-                 dump_path=None
+                 dump_path=None,
+                 map_params=None,
+                 repair_budget=None,
+                 repair_mode="full"
                  ):
         self.robots: List[Optional[Robot]] = []
         self.tasks: List[Optional[Task]] = []
         self.__base_algorithm: BaseAlgorithm = base_algorithm
         self.__repair_k = repair_k
         self.self_repair = self_repair
+        # 自修复时任务分配的时间预算（秒），None表示分配至完成
+        self.repair_budget = repair_budget
+        # "full": 取消自修复涉及的机器人的全部计划并重新分配
+        # "incremental": 只取消出错机器人的剩余计划，其子任务插入到各机器人现有计划中
+        if repair_mode not in ("full", "incremental"):
+            raise ValueError(f"unknown repair mode {repair_mode}")
+        self.repair_mode = repair_mode
+        # 已知无法感知的(reg, robot)，自修复时不再分配
+        self.__unsensable = set()
 
         self.__finished_tasks = []
 
@@ -43,18 +200,23 @@ class MACrowdSystem:
         grid_size, regions = self.sense_area.grid(self.grid_granularity)
         self.Regions: List[Region] = regions
         self.grid_size = grid_size
+        # 机器人位置索引，用于选取自修复涉及的最近的机器人
+        self.robot_index = RobotGrid(self.sense_area, self.grid_granularity)
 
         self.sense_time = sense_time
         self.time_granularity = time_granularity
         self.TS: List[TimeSlot] = sense_time.discretize(self.time_granularity)
 
         self.RC: List[RobotCategory] = robot_categorise
+        for rc in self.RC:
+            rc.buildTables(self.Regions)
 
         map_size = (len(self.Regions), len(self.TS), len(self.RC))
         self.senseMap = SenseMap(
             map_size, self.Regions, self.grid_size,
             self.sense_area.len, self.TS, self.RC,
-            map_file=map_file, dump_path=dump_path
+            map_file=map_file, dump_path=dump_path,
+            **(map_params or {})
         )
 
         self.info_save = info_save
@@ -70,6 +232,7 @@ class MACrowdSystem:
 
     def registerRobot(self, robot):
         self.robots.append(robot)
+        self.robot_index.insert(robot)
 
     def run(self):
         # self.senseMap.creation()
@@ -92,11 +255,14 @@ class MACrowdSystem:
         except StopIteration:
             pass
 
+        exec_robots = self.robots
+        start_time = 0
         while len(self.__finished_tasks) != len(self.tasks):
             # 执行感知任务
             print("\n### MASys: start execution ###")
-            message = yield from self.__execMissions()
+            message = yield from self.__execMissions(exec_robots, start_time)
             print(f"### something wrong: {message} ###")
+            start_time = message.real_time
             if self.__needRepairing(message):
                 # 自修复前先画图
                 plt = pltMASys(self, True, self.info_save)
@@ -105,10 +271,25 @@ class MACrowdSystem:
                 # 构建新的T和R
                 print("### MASys: start self repairing ###")
                 k = int(self.__repair_k * len(self.robots))
-                new_tasks, new_robots = self.__constructNewPlan(message, k)
-                yield FeedBack(1, new_robots)
-                self.__base_algorithm.new_allocationPlan(new_tasks, new_robots, self.senseMap)
-                self.__base_algorithm.allocationTasks()
+                # 出错的机器人无法感知该区域，之后不再将该区域的子任务分配给它，避免子任务在无法感知的机器人之间反复转移
+                if message.status_code == 3:
+                    self.__unsensable.add((message.region, message.robot))
+                if self.repair_mode == "incremental":
+                    # 增量修复在重新启动机器人之前完成，因为需要启动的机器人取决于插入结果
+                    exec_robots = self.__incrementalRepair(message, k)
+                    yield FeedBack(1, exec_robots)
+                else:
+                    new_tasks, new_robots = self.__constructNewPlan(message, k)
+                    exec_robots = new_robots
+                    yield FeedBack(1, new_robots)
+                    self.__base_algorithm.new_allocationPlan(new_tasks, new_robots, self.senseMap,
+                                                             excluded=self.__unsensable)
+                    if k < len(self.robots):
+                        self.__keepOutsidePlans(new_tasks, new_robots)
+                    report = self.__base_algorithm.allocationTasks(time_budget=self.repair_budget)
+                    if not report.finished:
+                        print(f"### MASys: repair budget exhausted after {report.steps} steps, "
+                              f"{report.unallocated} samples unallocated, continue at the next message ###")
 
                 # print 修复结果
                 cov = self.__base_algorithm.totalCov()
@@ -132,9 +313,13 @@ class MACrowdSystem:
         robot_dist = sum(map(methodcaller('moveDistance'), self.robots))
         return cov_rate, robot_dist
 
-    def __execMissions(self):
-        for r in self.robots:
+    def __execMissions(self, robots, start_time):
+        # 只启动新分配了任务的机器人，其余机器人仍在执行原有计划
+        for r in robots:
             r.executeMissions()
+        # 预算用完时若所有机器人都已无任务可执行，之后不会再有消息，因此在启动前继续分配
+        if self.__base_algorithm.pending and self.__stalled():
+            self.__resumeAllocation(start_time)
         message = yield
         while True:
             feed_back = FeedBack(0)
@@ -142,6 +327,10 @@ class MACrowdSystem:
                 self.senseMap.update(message.region, message.real_time, message.robot)
                 if self.senseMap.update_ratio >= 0.8:
                     return message
+                if self.__base_algorithm.pending:
+                    # 发送消息的机器人的协程仍在运行，只需切换状态；其余机器人的协程已经结束，由Simulator重建
+                    restart = self.__resumeAllocation(message.real_time)
+                    feed_back = FeedBack(0, [r for r in restart if r is not message.robot])
             elif message.status_code == 3:
                 # 当机器人无法感知某区域时, 我们将完成时间设置为一个非常大的数。
                 # 这样感知图中该点的表现会很差
@@ -155,6 +344,50 @@ class MACrowdSystem:
                 return message
             message = yield feed_back
 
+    def __resumeAllocation(self, time) -> List[Robot]:
+        """
+        继续因repair_budget用完而中断的分配：从尚未分配的子任务重新开始，新的子任务追加在各机器人计划的末尾。
+        若本次预算用完时所有机器人仍无任务可执行，则继续分配，直至有机器人可以执行任务或分配完成。
+        :param time: 当前时间，已完成所有任务的机器人从此时开始计划
+        :return: 原本已完成所有任务、现在又被分配了任务并已启动的机器人
+        """
+        algorithm = self.__base_algorithm
+        finished = [r for r in algorithm.robots if r.isFinishMissions]
+        for r in finished:
+            r.cancelPlan(time, self.Regions)
+        algorithm.resetSteps()
+        while True:
+            report = algorithm.allocationTasks(time_budget=self.repair_budget)
+            print(f"### MASys: resumed allocation, {report.steps} steps, {report.unallocated} samples unallocated ###")
+            if report.finished or not self.__stalled(finished):
+                break
+
+        restart = self.__assignedStartPoints(finished)
+        for r in restart:
+            r.executeMissions()
+        return restart
+
+    @staticmethod
+    def __assignedStartPoints(robots) -> List[Robot]:
+        """
+        建立了新起点的机器人中被分配了新任务的机器人；其余机器人撤销新起点，恢复为已完成所有任务
+        """
+        assigned = []
+        for r in robots:
+            if r.current_cursor + 1 == len(r.planned_path):
+                r.clearRecord(r.current_cursor)
+            else:
+                assigned.append(r)
+        return assigned
+
+    def __stalled(self, restarting=()):
+        """
+        是否所有机器人都已无任务可执行，此时之后不会再有消息
+        :param restarting: 已建立新起点、等待启动的机器人
+        """
+        return all(r.current_cursor + 1 == len(r.planned_path) if r in restarting else r.isFinishMissions or r.isBroken
+                   for r in self.robots)
+
     def __needRepairing(self, message: Message):
         if message.status_code != 0 or self.senseMap.update_ratio > 0.8:
             return True
@@ -174,18 +407,73 @@ class MACrowdSystem:
                     break
             assert target_r == message.robot
 
-            most_near = queue.PriorityQueue(k)
-            for r in self.robots:
-                most_near.put((target_r.distBetweenRobot(r), r))
-
-            new_robots: List[Robot] = [t[1] for t in most_near.queue]
-            new_tasks = list(reduce(operator.or_, [x.unfinishedTasks() for x in new_robots]))
+            new_robots: List[Robot] = self.__repairNeighbors(target_r, k)
+            # 只重新分配邻域内机器人计划中的任务，按任务发布的顺序排列
+            planned = reduce(operator.or_, [x.unfinishedTasks() for x in new_robots])
+            new_tasks = [t for t in self.tasks if t in planned and t.alive and not t.Finished]
 
         # 取消自修复涉及到的机器人的任务计划
         for r in new_robots:
             r.cancelPlan(message.real_time, self.Regions)
         return new_tasks, new_robots
 
+    def __keepOutsidePlans(self, tasks, robots):
+        """
+        部分自修复时，邻域外的机器人保持原有计划：其计划中尚未完成的子任务记为已分配，
+        只有邻域内机器人被取消的子任务会被重新分配，避免同一子任务被分配两次
+        """
+        tasks = set(tasks)
+        robots = set(robots)
+        for r in self.robots:
+            if r in robots or r.isBroken:
+                continue
+            for reg, reg_tasks in zip(r.planned_path[r.current_cursor:], r.task_in_reg[r.current_cursor:]):
+                for task in reg_tasks:
+                    if task in tasks:
+                        self.__base_algorithm.allocationPlan.add(task.id, reg.id, r.id)
+
+    def __incrementalRepair(self, message, k) -> List[Robot]:
+        """
+        增量自修复：出错的机器人取消剩余计划（出错的子任务及依赖于它的后续计划），
+        这些子任务依次以最便宜插入的方式加入k个最近的机器人的现有计划，其余计划保持不变。
+        :return: 需要重新启动的机器人，即出错的机器人与原本已完成所有任务、现在又被分配了任务的机器人
+        """
+        target_r: Robot = message.robot
+        orphans = {
+            (task, reg): None
+            for reg, tasks in zip(target_r.planned_path[target_r.current_cursor:],
+                                  target_r.task_in_reg[target_r.current_cursor:])
+            if not target_r.isFinishMissions
+            for task in tasks
+            if task is not None and task.alive and not task.Finished and task.subtask_status[reg.id] != 0
+        }
+        target_r.cancelPlan(message.real_time, self.Regions)
+        # 取消的子任务将重新插入，先从分配方案中移除出错机器人的这些采样
+        plan = self.__base_algorithm.allocationPlan
+        for task, reg in orphans:
+            if (task.id, reg.id, target_r.id) in plan:
+                plan.remove(task.id, reg.id, target_r.id)
+
+        if k < len(self.robots):
+            candidates = self.__repairNeighbors(target_r, k)
+        else:
+            candidates = [r for r in self.robots if not r.isBroken]
+        # 已完成所有任务的机器人从当前时间开始计划
+        finished = [r for r in candidates if r.isFinishMissions and r is not target_r]
+        for r in finished:
+            r.cancelPlan(message.real_time, self.Regions)
+
+        report = self.__base_algorithm.insertTasks(list(orphans), candidates, self.senseMap,
+                                                   excluded=self.__unsensable)
+        print(f"### MASys: inserted {report.steps} subtasks, {report.unallocated} unallocated ###")
+        return [target_r] + self.__assignedStartPoints(finished)
+
+    def __repairNeighbors(self, target_r: Robot, k) -> List[Robot]:
+        """
+        自修复涉及的机器人：距离target_r最近的k个未损坏的机器人（包括target_r），距离相同时robot.id小者优先
+        """
+        return self.robot_index.nearest(target_r.location, k, lambda r: not r.isBroken)
+
     def __decomposeTask(self, task: Task):
         assert not task.TR
         for reg in self.Regions:
@@ -205,36 +493,150 @@ class BaseAlgorithm(ABC):
 
         self.area_max_dist = (area_len[0]**2 + area_len[1] ** 2)**0.5
 
-        self.allocationPlan = {}
-        self.sampleRecord = {}
+        self.allocationPlan = AllocationPlan()
         self.GAMMA = gamma
+        # 不能分配的(reg, robot)，如机器人无法感知的区域
+        self.excluded = ()
+        # 未完成的分配过程，下次调用allocationTasks时继续
+        self.__steps = None
 
-    def new_allocationPlan(self, tasks, robots, s_map, kappa=0.03):
+    def new_allocationPlan(self, tasks, robots, s_map, kappa=0.03, excluded=()):
         self.tasks = tasks
         self.robots = robots
         self.sense_map = s_map
         self.kappa = kappa
+        self.excluded = excluded
         self.allocationPlan.clear()
-        self.sampleRecord.clear()
         assert not self.allocationPlan
+        self.resetSteps()
 
-    @abstractmethod
-    def allocationTasks(self):
+    def allocationTasks(self, time_budget=None, step_budget=None) -> AllocationReport:
         """
         任务分配基算法，就地分配任务给机器人
+        超过时间预算（秒）或分配次数预算时停止，此时已分配的部分仍然有效，
+        再次调用会从中断处继续分配，直到new_allocationPlan开始新的分配
+        """
+        if self.__steps is None:
+            self.__steps = self.allocationSteps()
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        steps = 0
+        try:
+            allocated = next(self.__steps)
+            while True:
+                if allocated is not False:
+                    steps += 1
+                exhausted = (step_budget is not None and steps >= step_budget) \
+                    or (deadline is not None and time.perf_counter() >= deadline)
+                if exhausted and allocated is not False:
+                    break
+                # 检查点不计入分配次数，预算用完时通知生成器尽快给出已有的分配
+                allocated = self.__steps.send(exhausted)
+        except StopIteration:
+            self.__steps = None
+        unallocated = self.unallocated()
+        if self.__steps is not None and not unallocated:
+            # 预算恰好在最后一次分配时用完，生成器已无可分配的子任务
+            self.__steps.close()
+            self.__steps = None
+        return AllocationReport(self.__steps is None, steps, unallocated)
+
+    def resetSteps(self):
+        """
+        丢弃中断的分配过程，下次调用allocationTasks时从allocationPlan中尚未分配的子任务重新开始。
+        中断后机器人执行了任务，计划已经改变，分配过程中缓存的效用与完成时间不再有效
+        """
+        if self.__steps is not None:
+            self.__steps.close()
+            self.__steps = None
+
+    @property
+    def pending(self) -> bool:
+        """
+        是否有因预算用完而中断、尚未继续的分配
         """
+        return self.__steps is not None
+
+    @abstractmethod
+    def allocationSteps(self):
+        """
+        分配过程的生成器，每完成一次分配yield一次。
+        耗时的计算中可以yield False作为检查点，不计入分配次数；预算用完时检查点收到True，此时应尽快给出已有的分配
+        """
+
+    def insertTasks(self, subtasks, robots, s_map, kappa=0.03, excluded=()) -> AllocationReport:
+        """
+        增量修复：将subtasks依次以最便宜插入(cheapest insertion)的方式插入robots现有计划中当前任务之后的位置，
+        每个子任务选取insertionUtility最大、且不会使计划中任何任务超时的(机器人, 位置, 传感器)。
+        插入的采样合并到现有的allocationPlan中，统计仍覆盖之前分配的全部任务与机器人
+        :param subtasks: [(task, reg)]
+        :param excluded: 不能分配的(reg, robot)
+        :return: steps为插入的子任务数，unallocated为无法插入的子任务数
+        """
+        self.tasks = self.tasks + [t for t in dict.fromkeys(task for task, _ in subtasks) if t not in self.tasks]
+        self.robots = self.robots + [r for r in robots if r not in self.robots]
+        self.sense_map = s_map
+        self.kappa = kappa
+        inserted = 0
+        for task, reg in subtasks:
+            best = None
+            for r in robots:
+                if r.isBroken or (reg, r) in excluded:
+                    continue
+                for sensor in r.C.adequateSensors(task):
+                    for pos in range(r.insertion_start, len(r.planned_path) + 1):
+                        plan = r.replanSuffix(pos, r.insertionEntries(pos, reg, task, sensor))
+                        if plan is None:
+                            continue
+                        u = self.insertionUtility(r, reg, plan.finish_time[0],
+                                                  plan.planned_distance[-1] - r.planned_distance[-1])
+                        if best is None or u > best[0]:
+                            best = (u, r, pos, sensor)
+            if best is not None:
+                _, r, pos, sensor = best
+                r.insertTask(pos, reg, task, sensor)
+                self.allocationPlan.add(task.id, reg.id, r.id)
+                inserted += 1
+        return AllocationReport(True, inserted, len(subtasks) - inserted)
+
+    def insertionUtility(self, r: Robot, reg: Region, finish_time, added_distance):
+        """
+        插入子任务的效用，默认为增加的移动距离越小越好
+        """
+        return -added_distance
+
+    def unallocated(self) -> int:
+        """
+        仍可执行的子任务尚未分配的采样次数
+        """
+        return sum(max(0, self.GAMMA - self.allocationPlan.samples(task.id, reg.id))
+                   for task in self.tasks if not task.Finished and task.alive
+                   for reg in task.TR if task.subtask_status[reg.id] != 0)
+
+    @property
+    def sampleRecord(self):
+        """
+        (task.id, reg.id) -> 采样次数，为allocationPlan的只读视图
+        """
+        return self.allocationPlan.sample_record
 
     def totalCov(self):
-        cov = 0
-        for task in self.tasks:
-            s = sum(self.allocationPlan.get((task.id, reg.id, r.id), 0)
-                    for reg in task.TR
-                    for r in self.robots)
-            cov += s / len(task.TR) / self.GAMMA
-        cov_rate = cov / len(self.tasks)
+        if not self.tasks:  # 没有需要分配的任务
+            return 1.0
+        cov = self.allocationPlan.taskCompletion([task.id for task in self.tasks],
+                                                 [len(task.TR) for task in self.tasks],
+                                                 self.GAMMA,
+                                                 [r.id for r in self.robots])
+        # 按任务顺序累加，与逐个任务累加的结果相同
+        cov_rate = sum(cov.tolist()) / len(self.tasks)
         assert cov_rate <= 1.0
         return cov_rate
 
+    def robotLoad(self):
+        """
+        每个机器人被分配的采样次数
+        """
+        return self.allocationPlan.robotLoad([r.id for r in self.robots])
+
     def robotDis(self):
         return sum(map(methodcaller('moveDistance'), self.robots))
 
@@ -246,120 +648,411 @@ class GreedyBaseAlgorithm(BaseAlgorithm, ABC):
         self.THETAS = [t/len(thetas) for t in thetas]
         self.LAMBDAS = (1, self.area_max_dist, 1)
 
-    @abstractmethod
-    def allocationTasks(self):
-        pass
+        # 仍需分配的子任务(task, reg)，按任务、区域的顺序排列
+        self.open_subtasks = {}
+        # robot.id -> 该机器人有合适传感器的子任务
+        self.robot_candidates = {}
+
+    def indexCandidates(self):
+        """
+        建立仍需分配的子任务集合与每个机器人的候选子任务索引
+        """
+        self.open_subtasks = {
+            (task, reg): None
+            for task in self.tasks if not task.Finished and task.alive
+            for reg in task.TR
+            if task.subtask_status[reg.id] != 0 and self.allocationPlan.samples(task.id, reg.id) < self.GAMMA
+        }
+        task_index = {task: j for j, task in enumerate(self.tasks)}
+        mask = feasibilityMask(self.robots, self.tasks)
+        self.robot_candidates = {
+            r.id: {
+                (task, reg): None
+                for task, reg in self.open_subtasks
+                if mask[i, task_index[task]] and (reg, r) not in self.excluded
+            }
+            for i, r in enumerate(self.robots)
+        }
+
+    def sampleSubtask(self, task: Task, reg: Region, robot: Robot):
+        """
+        记录robot对子任务的一次采样，子任务满足采样次数后移出open_subtasks
+        """
+        self.allocationPlan.add(task.id, reg.id, robot.id)
+        if self.allocationPlan.samples(task.id, reg.id) >= self.GAMMA:
+            self.open_subtasks.pop((task, reg), None)
+
+    def openCandidates(self, robot: Robot):
+        """
+        robot仍未完成的候选子任务，同时从索引中剔除已完成的子任务
+        """
+        candidates = self.robot_candidates[robot.id]
+        for key in [key for key in candidates if key not in self.open_subtasks]:
+            del candidates[key]
+        return list(candidates)
 
     def DeltaUtility(self, reg: Region, r: Robot, at: int):
-        f1 = self.THETAS[0] * 1 / self.LAMBDAS[0]
-        f2 = self.THETAS[1] * (r.planned_distance[-1] + r.taskDistance(reg)) / self.LAMBDAS[1]
+        ts = self.sense_map.time_cycle.slotIndex(at)
+        return deltaUtility(self.THETAS, self.LAMBDAS, r.planned_distance[-1], r.taskDistance(reg),
+                            self.sense_map.acquireFunction((reg, ts, r.C), self.kappa))
 
-        try:
-            ts = list(filter(lambda t: at in t, self.sense_map.TimeSlots))[0]
-        except IndexError:
-            raise ValueError(f"error arrival time {at}")
-        f3 = self.THETAS[2] * self.sense_map.acquireFunction((reg, ts, r.C), self.kappa) / self.LAMBDAS[2]
-        return f1 - f2 + f3
+    def insertionUtility(self, r: Robot, reg: Region, finish_time, added_distance):
+        # 在计划末尾追加时与DeltaUtility相同
+        ts = self.sense_map.time_cycle.slotIndex(finish_time)
+        return deltaUtility(self.THETAS, self.LAMBDAS, r.planned_distance[-1], added_distance,
+                            self.sense_map.acquireFunction((reg, ts, r.C), self.kappa))
+
+    def DeltaUtilityBatch(self, reg_ids, robots: List[Robot], times) -> np.ndarray:
+        """
+        DeltaUtility的向量化版本，第i个元素为robots[i]在times[i]完成reg_ids[i]区域感知的ΔU
+        机器人的距离由各类别的距离表查得，时间段由TimeCycle直接算出，acquireFunction批量索引感知图
+        """
+        reg_ids = np.asarray(reg_ids, dtype=int)
+        rc_ids = np.array([r.C.id for r in robots], dtype=int)
+        last_regs = np.array([r.planned_path[-1].id for r in robots], dtype=int)
+        planned = np.array([r.planned_distance[-1] for r in robots], dtype=float)
+
+        task_distance = np.empty(len(reg_ids))
+        for rc in {r.C for r in robots}:
+            inter_d, intra_d = self.distanceTable(rc)
+            mask = rc_ids == rc.id
+            task_distance[mask] = inter_d[last_regs[mask], reg_ids[mask]] + intra_d[reg_ids[mask]]
+
+        tss = self.sense_map.time_cycle.slotIndices(times)
+        acquire = self.sense_map.acquireBatch(reg_ids, tss, rc_ids, self.kappa)
+        return deltaUtility(self.THETAS, self.LAMBDAS, planned, task_distance, acquire)
+
+    def distanceTable(self, rc: RobotCategory) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        rc类机器人在感知图区域之间的移动距离表inter_d[reg1, reg2]与区域内的移动距离intra_d[reg]
+        """
+        if rc.tables is None or rc.tables.regions is not self.sense_map.Regions:
+            rc.buildTables(self.sense_map.Regions)
+        return rc.tables.inter_d, rc.tables.intra_d
 
 
 class RobotOrientAlgorithm(GreedyBaseAlgorithm):
+    """
+    每次选取ΔU最大的分配方案(task, reg, robot)。
+    候选方案存放在最大堆中并带有版本号，方案的ΔU重新计算后旧版本在出堆时丢弃（延迟失效），
+    已满足采样次数的子任务同样在出堆时丢弃。ΔU相同时选取最早加入的方案。
+    workers > 1 时，初始的候选方案按机器人划分到进程池中并行评估，之后的贪心选取仍在本进程中依次进行。
+    """
 
-    def allocationTasks(self):
-        record_u = {}
-        for task in self.tasks:
-            if task.Finished or not task.alive:  # 可以完成的任务无需分配或已无法分配
-                continue
-            for reg in task.TR:
-                if task.subtask_status[reg.id] == 0:  # 可以完成的子任务无需分配
-                    continue
-                for r in self.robots:
-                    finish_time, select_sensor = min(r.possiblePlan(reg, task))
-                    if finish_time not in task.timeRange or not select_sensor:
-                        continue
-                    record_u[task, reg, r] = self.DeltaUtility(reg, r, finish_time), select_sensor
-        test = [(value[0], key) for key, value in record_u.items()]
-        test.sort(key=lambda x: x[0], reverse=True)
+    def __init__(self, area_len, gamma=1, thetas=(1, 1, 3), workers=None):
+        super().__init__(area_len, gamma, thetas)
+        self.workers = workers
 
-        while True:
+    def allocationSteps(self):
+        heap = []
+        versions = {}
+        order = {}
+        counter = itertools.count()
+
+        self.indexCandidates()
+        sweep = self.__parallelSweep() if self.workers and self.workers > 1 else self.__serialSweep()
+        for key, u, select_sensor in sweep:
+            self.__push(heap, versions, order, counter, key, u, select_sensor)
+
+        while heap:
 
             # 贪心选取一种分配方案
-            max_u_s = None
-            max_key = None
-            for key, u_s in record_u.items():
-                if self.sampleRecord.get((key[0].id, key[1].id), 0) >= self.GAMMA:
-                    continue
-                if not max_u_s or u_s > max_u_s:
-                    max_u_s = u_s
-                    max_key = key
-            if max_key is None:
-                break
-            task, reg, robot_star = max_key
+            _, _, version, key, sensor = heapq.heappop(heap)
+            task, reg, robot_star = key
             robot_star: Robot
-            _, sensor = max_u_s
+            if versions.get(key) != version or (task, reg) not in self.open_subtasks:
+                continue
 
             # 分配任务
             robot_star.assignTask(reg, task, sensor)
-            self.allocationPlan[task.id, reg.id, robot_star.id] = 1
-            self.sampleRecord[task.id, reg.id] = self.sampleRecord.get((task.id, reg.id), 0) + 1
+            self.sampleSubtask(task, reg, robot_star)
 
             # 清除该记录
-            del record_u[task, reg, robot_star]
+            del versions[key]
+            self.robot_candidates[robot_star.id].pop((task, reg))
 
             # 更新该机器人与其他任务的$\Delta U$
-            for task in self.tasks:
-                if task.Finished or not task.alive:
+            for task, reg in self.openCandidates(robot_star):
+                finish_time, select_sensor = min(robot_star.possiblePlan(reg, task))
+                # 无法完成时保留该机器人原有的方案
+                if finish_time not in task.timeRange or not select_sensor:
                     continue
-                for reg in task.TR:
-                    if task.subtask_status[reg.id] == 0:
-                        continue
-                    if self.allocationPlan.get((task.id, reg.id, robot_star.id), 0):
-                        continue
-                    finish_time, select_sensor = min(robot_star.possiblePlan(reg, task))
-                    if finish_time not in task.timeRange or not select_sensor:
-                        continue
-                    record_u[task, reg, robot_star] = self.DeltaUtility(reg, robot_star,
-                                                                        finish_time), select_sensor
+                self.__push(heap, versions, order, counter, (task, reg, robot_star),
+                            self.DeltaUtility(reg, robot_star, finish_time), select_sensor)
+            yield
+
+    def __serialSweep(self):
+        """
+        初始的候选方案，按子任务、机器人的顺序排列
+        :return: [((task, reg, robot), ΔU, 传感器)]
+        """
+        keys, finish_times, sensors = [], [], []
+        for task, reg in self.open_subtasks:
+            for r in self.robots:
+                if (task, reg) not in self.robot_candidates[r.id]:
+                    continue
+                finish_time, select_sensor = min(r.possiblePlan(reg, task))
+                if finish_time not in task.timeRange or not select_sensor:
+                    continue
+                keys.append((task, reg, r))
+                finish_times.append(finish_time)
+                sensors.append(select_sensor)
+        if not keys:
+            return []
+        utilities = self.DeltaUtilityBatch([reg.id for _, reg, _ in keys], [r for _, _, r in keys], finish_times)
+        return list(zip(keys, utilities.tolist(), sensors))
+
+    def __parallelSweep(self):
+        """
+        与__serialSweep相同，但按机器人划分到进程池中计算。
+        每个进程得到子任务、acquireFunction数组与距离表的只读快照，每个任务得到一个机器人的快照，
+        结果按子任务、机器人的顺序合并，因此与串行计算的结果一致。
+        """
+        subtasks = list(self.open_subtasks)
+        position = {key: i for i, key in enumerate(subtasks)}
+        jobs = [(r, [position[key] for key in self.robot_candidates[r.id]]) for r in self.robots]
+        acquire = self.sense_map.mu + self.kappa * self.sense_map.sigma
+        tables = {r.C.id: self.distanceTable(r.C) for r in self.robots}
+        state = (subtasks, acquire, tables, self.sense_map.time_cycle, self.THETAS, self.LAMBDAS)
+
+        merged = []
+        with ProcessPoolExecutor(self.workers, initializer=_initSweep, initargs=(state,)) as pool:
+            chunksize = max(1, len(jobs) // (4 * self.workers))
+            for j, result in enumerate(pool.map(_sweepRobot, jobs, chunksize=chunksize)):
+                r = self.robots[j]
+                for i, finish_time, sensor_index, u in result:
+                    merged.append((i, j, (subtasks[i][0], subtasks[i][1], r), u, r.C.sensors[sensor_index]))
+        merged.sort(key=lambda item: item[:2])
+        return [item[2:] for item in merged]
+
+    @staticmethod
+    def __push(heap, versions, order, counter, key, u, sensor):
+        # 堆按(-ΔU, 方案首次加入的次序)排序，次序唯一，因此不会比较到后面的对象
+        version = versions[key] = versions.get(key, -1) + 1
+        heapq.heappush(heap, (-u, order.setdefault(key, next(counter)), version, key, sensor))
 
 
 class TaskOrientAlgorithm(GreedyBaseAlgorithm):
 
-    def allocationTasks(self):
+    def allocationSteps(self):
+        self.indexCandidates()
         task_in_reg = {}
-        for task in self.tasks:
-            if task.Finished or not task.alive:
-                continue
-            for reg in task.TR:
-                if task.subtask_status[reg.id] == 0:
-                    continue
-                task_in_reg.setdefault(reg, []).append(task)
+        for task, reg in self.open_subtasks:
+            task_in_reg.setdefault(reg, []).append(task)
 
         for reg, tasks in task_in_reg.items():
             task: Task
             for task in tasks:
-                u_max = None
-                r_max = None
-                s_select = None
+                robots, finish_times, sensors = [], [], []
                 for rob in self.robots:
+                    if (task, reg) not in self.robot_candidates[rob.id]:
+                        continue
                     finish_time, select_sensors = min(rob.possiblePlan(reg, task))
-                    sample_times = self.allocationPlan.get((task, reg, rob), 0)
+                    sample_times = self.allocationPlan.get((task.id, reg.id, rob.id), 0)
                     if finish_time not in task.timeRange or not select_sensors or sample_times >= self.GAMMA:
                         continue
-                    u = self.DeltaUtility(reg, rob, finish_time)
-                    if u_max is None or u > u_max:
-                        u_max = u
-                        r_max = rob
-                        s_select = select_sensors
-                if r_max:
+                    robots.append(rob)
+                    finish_times.append(finish_time)
+                    sensors.append(select_sensors)
+                if robots:
+                    # argmax在ΔU相同时取第一个，与逐个比较时一致
+                    best = int(np.argmax(self.DeltaUtilityBatch([reg.id] * len(robots), robots, finish_times)))
+                    r_max = robots[best]
+                    s_select = sensors[best]
                     r_max.assignTask(reg, task, s_select)
-                    ap = (task.id, reg.id, r_max.id)
-                    self.allocationPlan[ap] = self.allocationPlan.get(ap, 0) + 1
+                    self.allocationPlan.add(task.id, reg.id, r_max.id)
+                    yield
+
+
+class AuctionAlgorithm(GreedyBaseAlgorithm):
+    """
+    基于市场的分配算法（CBBA式的bundle竞标）。
+    每一轮中，各机器人在自身计划的快照上独立构建bundle：依次追加ΔU最大、且能胜过当前中标者的子任务，
+    bid为追加时的ΔU（不超过bundle中前一个bid）；
+    之后进行一致性处理：每个子任务保留bid最高的(gamma - 已采样次数)个机器人，bid相同时机器人序号小者优先，机器人的bundle在第一个落选的子任务处截断（之后的bid依赖于该子任务）。
+    bundle不再变化或达到max_rounds轮后，按bundle的顺序分配任务，之后对仍未分配的子任务开始新的竞标，直至没有子任务可以分配。
+    各机器人每个bundle位置的候选评估在轮次之间保留，只有被一致性处理截断之后的位置需要重新计算。
+    每一轮结束时yield一个检查点，预算用完时直接分配当前（已无冲突的）bundle。
+    workers > 1 时，bundle的构建在进程池中并行进行，结果与串行相同。
+    :param bundle_size: 每个机器人bundle的最大长度，None表示不限
+    """
+
+    def __init__(self, area_len, gamma=1, thetas=(1, 1, 3), workers=None, max_rounds=50, bundle_size=5):
+        super().__init__(area_len, gamma, thetas)
+        self.workers = workers
+        self.max_rounds = max_rounds
+        self.bundle_size = bundle_size
+        # 最近一次分配进行的轮数
+        self.rounds = 0
+
+    def allocationSteps(self):
+        self.indexCandidates()
+        self.rounds = 0
+        while self.open_subtasks:
+            subtasks = list(self.open_subtasks)
+            bundles = yield from self.__auction(subtasks)
+            if not any(bundles):
+                break
+            for r, bundle in zip(self.robots, bundles):
+                for i, sensor_index, _ in bundle:
+                    task, reg = subtasks[i]
+                    r.assignTask(reg, task, r.C.sensors[sensor_index])
+                    self.sampleSubtask(task, reg, r)
+                    self.robot_candidates[r.id].pop((task, reg))
+                    yield
+
+    def __auction(self, subtasks):
+        """
+        进行竞标与一致性处理，每一轮结束时yield False作为检查点，收到True时停止竞标
+        :return: 每个机器人最终的bundle
+        """
+        position = {key: i for i, key in enumerate(subtasks)}
+        capacity = [self.GAMMA - self.allocationPlan.samples(task.id, reg.id) for task, reg in subtasks]
+        candidates = [[position[key] for key in self.openCandidates(r)] for r in self.robots]
+        blobs = [pickle.dumps(r) for r in self.robots]
+        acquire = self.sense_map.mu + self.kappa * self.sense_map.sigma
+        tables = {r.C.id: self.distanceTable(r.C) for r in self.robots}
+        state = (subtasks, acquire, tables, self.sense_map.time_cycle, self.THETAS, self.LAMBDAS, self.bundle_size)
+
+        parallel = self.workers and self.workers > 1
+        pool = ProcessPoolExecutor(self.workers, initializer=_initSweep, initargs=(state,)) if parallel else None
+        # 一致性处理之后的bundle，以及各机器人上一次构建的bundle、评估缓存与需要胜过的bid
+        bundles = [[] for _ in self.robots]
+        built = [[] for _ in self.robots]
+        caches = [[] for _ in self.robots]
+        outbids = [None for _ in self.robots]
+        try:
+            for _ in range(self.max_rounds):
+                self.rounds += 1
+                winners = self.__winners(bundles)
+                jobs = []
+                for j, blob in enumerate(blobs):
+                    outbid = {i: winners[i][-1] for i in candidates[j]
+                              if len(winners.get(i, ())) >= capacity[i]}
+                    # bundle未被截断、需要胜过的bid也没有变化时，重新构建的bundle与上一次相同
+                    if bundles[j] == built[j] and outbid == outbids[j]:
+                        continue
+                    outbids[j] = outbid
+                    jobs.append((blob, j, candidates[j], bundles[j], outbid, caches[j]))
+                if pool is None:
+                    results = [bundleBids(state, job) for job in jobs]
+                else:
+                    chunksize = max(1, len(jobs) // (4 * self.workers))
+                    results = list(pool.map(_bidRobot, jobs, chunksize=chunksize))
+                for job, (bundle, cache) in zip(jobs, results):
+                    j = job[1]
+                    built[j], caches[j] = bundle, cache
+                new_bundles = self.__consensus(built, capacity)
+                if new_bundles == bundles:
+                    break
+                bundles = new_bundles
+                if (yield False):
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return bundles
+
+    @staticmethod
+    def __winners(bundles):
+        """
+        :return: 子任务下标 -> 按(bid, -机器人序号)从大到小排列的中标者
+        """
+        winners = {}
+        for j, bundle in enumerate(bundles):
+            for i, _, u in bundle:
+                winners.setdefault(i, []).append((u, -j))
+        for bids in winners.values():
+            bids.sort(reverse=True)
+        return winners
+
+    @classmethod
+    def __consensus(cls, bundles, capacity):
+        """
+        每个子任务保留bid最高的capacity个机器人，落选的机器人在该子任务处截断bundle
+        """
+        winners = {i: {-j for _, j in bids[:capacity[i]]} for i, bids in cls.__winners(bundles).items()}
+        result = []
+        for j, bundle in enumerate(bundles):
+            for k, (i, _, _) in enumerate(bundle):
+                if j not in winners[i]:
+                    bundle = bundle[:k]
+                    break
+            result.append(bundle)
+        return result
+
+
+class AssignmentAlgorithm(GreedyBaseAlgorithm):
+    """
+    按轮分配：每一轮由机器人 * 子任务的ΔU矩阵求解一次最优指派(linear_sum_assignment)，
+    每个机器人至多分配一个子任务，每个子任务至多分配一次。
+    分配后只有被分配的机器人的ΔU发生变化，因此只重新计算这些行；已满足采样次数的子任务对应的列被剔除。
+    """
+
+    def allocationSteps(self):
+        self.indexCandidates()
+        subtasks = list(self.open_subtasks)
+        position = {key: i for i, key in enumerate(subtasks)}
+        utility = np.full((len(self.robots), len(subtasks)), -np.inf)
+        sensors = {}
+        for j in range(len(self.robots)):
+            self.__refreshRow(utility, sensors, position, j)
+
+        while True:
+            rows = np.flatnonzero(np.isfinite(utility).any(axis=1))
+            cols = np.flatnonzero(np.isfinite(utility[rows]).any(axis=0))
+            if not len(rows) or not len(cols):
+                break
+            matrix = utility[np.ix_(rows, cols)]
+            feasible = np.isfinite(matrix)
+            # 不可行的方案取足够小的值，使最优指派优先选取更多可行的方案
+            low, high = matrix[feasible].min(), matrix[feasible].max()
+            matrix = np.where(feasible, matrix, low - (high - low + 1) * min(matrix.shape))
+            assigned = []
+            for a, b in zip(*linear_sum_assignment(matrix, maximize=True)):
+                if not feasible[a, b]:
+                    continue
+                j, i = rows[a], cols[b]
+                task, reg = subtasks[i]
+                robot = self.robots[j]
+                robot.assignTask(reg, task, sensors[j, i])
+                self.sampleSubtask(task, reg, robot)
+                self.robot_candidates[robot.id].pop((task, reg))
+                assigned.append(j)
+                yield
+
+            # 满足采样次数的子任务不再参与分配
+            for i in cols:
+                if subtasks[i] not in self.open_subtasks:
+                    utility[:, i] = -np.inf
+            for j in assigned:
+                self.__refreshRow(utility, sensors, position, j)
+
+    def __refreshRow(self, utility, sensors, position, j):
+        """
+        重新计算第j个机器人对其候选子任务的ΔU，无法完成的子任务为-inf
+        """
+        robot = self.robots[j]
+        utility[j] = -np.inf
+        indices, reg_ids, finish_times = [], [], []
+        for task, reg in self.openCandidates(robot):
+            finish_time, select_sensor = min(robot.possiblePlan(reg, task))
+            if finish_time not in task.timeRange or not select_sensor:
+                continue
+            i = position[task, reg]
+            sensors[j, i] = select_sensor
+            indices.append(i)
+            reg_ids.append(reg.id)
+            finish_times.append(finish_time)
+        if indices:
+            utility[j, indices] = self.DeltaUtilityBatch(reg_ids, [robot] * len(indices), finish_times)
 
 
 class RandomAlgorithm(BaseAlgorithm):
 
-    def allocationTasks(self):
+    def allocationSteps(self):
         subtasks = {
-            (task, reg): self.GAMMA
+            (task, reg): self.GAMMA - self.allocationPlan.samples(task.id, reg.id)
             for task in self.tasks if not task.Finished and task.alive
             for reg in task.TR if task.subtask_status[reg.id] != 0
         }
@@ -374,12 +1067,14 @@ class RandomAlgorithm(BaseAlgorithm):
                 # 随机选择robot
                 random.shuffle(op_robots)
                 for robot in op_robots:
+                    if (a_reg, robot) in self.excluded:
+                        continue
                     finish_time, select_sensor = min(robot.possiblePlan(a_reg, a_task))
                     if finish_time not in a_task.timeRange or not select_sensor:
                         continue
                     robot.assignTask(a_reg, a_task, select_sensor)
-                    self.allocationPlan[a_task.id, a_reg.id, robot.id] = 1
-                    self.sampleRecord[a_task.id, a_reg.id] = self.sampleRecord.get((a_task.id, a_reg.id), 0) + 1
+                    self.allocationPlan.add(a_task.id, a_reg.id, robot.id)
+                    yield
                     break
                 else:
                     # 如无合适的机器人，则不分配该任务
@@ -36,6 +36,9 @@ class RobotState(ABC):
     def broken(self):
         raise StateError(f"{type(self).__name__} cannot broken()")
 
+    def insertTask(self, pos, reg, task, used_sensor):
+        raise StateError(f"{type(self).__name__} cannot insertTask()")
+
     def assignTaskOpr(self, reg, task, used_sensor, ideal_time):  # todo 优化：函数形式
         # update task and sensor record
         robot = self.robot
@@ -50,19 +53,42 @@ class RobotState(ABC):
         time_used = ideal_time - robot.finish_time[-1]
         robot.ideal_time_used.append(time_used)
         robot.finish_time.append(ideal_time)
-        sensing_time = robot.C.intraD(reg) / robot.C.v
+        sensing_time = robot.C.sensingTime(reg)
         robot.ideal_sensing_time.append(sensing_time)
         robot.ideal_moving_time.append(time_used - sensing_time)
 
+    def insertTaskOpr(self, pos, reg, task, used_sensor):
+        # 在pos处插入任务，之后的计划顺延
+        robot = self.robot
+        if pos < robot.insertion_start:
+            raise ValueError(f"cannot insert task before position {robot.insertion_start}")
+        entries = robot.insertionEntries(pos, reg, task, used_sensor)
+        plan = robot.replanSuffix(pos, entries)
+        if plan is None:
+            raise ValueError(f"task{task.id} cannot be inserted at position {pos} in time")
+
+        robot.clearRecord(pos)
+        for reg, tasks, sensors in entries:
+            robot.planned_path.append(reg)
+            robot.task_in_reg.append(tasks)
+            robot.sensor_in_reg.append(sensors)
+        robot.planned_distance.extend(plan.planned_distance)
+        robot.finish_time.extend(plan.finish_time)
+        robot.ideal_time_used.extend(plan.ideal_time_used)
+        robot.ideal_moving_time.extend(plan.ideal_moving_time)
+        robot.ideal_sensing_time.extend(plan.ideal_sensing_time)
+
 
 class IdleState(RobotState):
 
     def cancelPlan(self, time, regions):
         # 在IdleState取消计划，则对于已完成任务的机器人应该将current_cursor恢复成类似初始状态的形式
+        # 给出time时，与MovingState相同，以当前区域建立新起点，之后的任务从time开始计划
         # todo 重构：这样的设计非常不好
-        if self.robot.current_cursor > 0:
+        if self.robot.isFinishMissions and time is not None:
+            self.robot.newStartPoint(time)
+        elif self.robot.current_cursor > 0:
             self.robot.current_cursor -= 1
-        pass
 
     def assignTask(self, reg, task, used_sensor):
         ideal_time = self.robot.idealFinishTime(reg, used_sensor, task)
@@ -76,6 +102,12 @@ class IdleState(RobotState):
 
         # self.robot.state = self.robot.idleState
 
+    def insertTask(self, pos, reg, task, used_sensor):
+        # 已完成所有任务的机器人先恢复成类似初始状态的形式，与cancelPlan相同
+        if self.robot.isFinishMissions:
+            self.cancelPlan(None, None)
+        self.insertTaskOpr(pos, reg, task, used_sensor)
+
     def executeMissions(self):
         self.robot.current_cursor += 1
         if self.robot.isFinishMissions:  # 当机器人未被分配任何任务时，触发此种情况
@@ -106,16 +138,7 @@ class MovingState(RobotState):
         # 更新相关record
         # 当处于movingState的robot cancelPlan() 时，根据当前reg建立新起点
         # 各record应和__init__中类似
-        robot.planned_path.append(robot.current_region)
-        robot.finish_time.append(time)  # 起点看为已完成任务，则finish time为当前时间
-        robot.task_in_reg.append([None])
-        robot.sensor_in_reg.append([None])
-        robot.ideal_time_used.append(0)
-        robot.ideal_moving_time.append(0)
-        robot.ideal_sensing_time.append(0)
-        # 需要更新计划距离
-        dis = robot.planned_distance[-1] + robot.C.interD(robot.planned_path[-2], robot.planned_path[-1])
-        robot.planned_distance.append(dis)
+        robot.newStartPoint(time)
 
         # 此时current_cursor不为0，但相当于初始状态
         robot.current_task_region = None
@@ -123,6 +146,16 @@ class MovingState(RobotState):
         # change state
         robot.state = robot.idleState
 
+    def assignTask(self, reg, task, used_sensor):
+        ideal_time = self.robot.idealFinishTime(reg, used_sensor, task)
+
+        # 与SensingState相同，只能在计划末尾追加任务，不能并发执行
+        self.assignTaskOpr(reg, task, used_sensor, ideal_time)
+
+    def insertTask(self, pos, reg, task, used_sensor):
+        # 只能插入到当前目标之后
+        self.insertTaskOpr(pos, reg, task, used_sensor)
+
     def sense(self, time):
 
         # 更新robot位置
@@ -174,6 +207,9 @@ class SensingState(RobotState):
 
         # self.robot.state = self.robot.sensingState
 
+    def insertTask(self, pos, reg, task, used_sensor):
+        self.insertTaskOpr(pos, reg, task, used_sensor)
+
     def cancelPlan(self, time, regions):
         assert self.robot.current_region == self.robot.current_task_region
         self.robot.location = self.robot.current_region.randomLoc()
@@ -0,0 +1,153 @@
+import types
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class AllocationPlan:
+    """
+    稀疏的任务分配方案。
+    以COO形式（task.id, reg.id, robot.id, 采样次数四列数组）记录每个分配，并用key_index定位某一分配所在的行；
+    同时维护每个子任务(task.id, reg.id)的采样次数。
+    覆盖率、机器人负载、任务完成度等统计都是对这几列数组的向量化归约，无需遍历task * reg * robot。
+    """
+
+    def __init__(self, capacity=64):
+        self.__task = np.zeros(capacity, dtype=np.int64)
+        self.__reg = np.zeros(capacity, dtype=np.int64)
+        self.__robot = np.zeros(capacity, dtype=np.int64)
+        self.__count = np.zeros(capacity, dtype=np.int64)
+        self.__size = 0
+        # (task.id, reg.id, robot.id) -> 行号
+        self.key_index: Dict[Tuple[int, int, int], int] = {}
+        # (task.id, reg.id) -> 采样次数
+        self.__samples: Dict[Tuple[int, int], int] = {}
+
+    def __len__(self):
+        return self.__size
+
+    def __contains__(self, key):
+        return key in self.key_index
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        return iter(self.key_index)
+
+    def __getitem__(self, key) -> int:
+        return int(self.__count[self.key_index[key]])
+
+    def get(self, key, default=0):
+        row = self.key_index.get(key)
+        return default if row is None else int(self.__count[row])
+
+    def items(self):
+        return [(key, int(self.__count[row])) for key, row in self.key_index.items()]
+
+    def clear(self):
+        self.__size = 0
+        self.key_index.clear()
+        self.__samples.clear()
+
+    def add(self, task_id, reg_id, robot_id, n=1):
+        """
+        robot对子任务(task, reg)增加n次采样
+        """
+        key = (task_id, reg_id, robot_id)
+        row = self.key_index.get(key)
+        if row is None:
+            if self.__size == len(self.__count):
+                self.__grow()
+            row = self.key_index[key] = self.__size
+            self.__task[row], self.__reg[row], self.__robot[row] = key
+            self.__count[row] = 0
+            self.__size += 1
+        self.__count[row] += n
+        self.__samples[task_id, reg_id] = self.__samples.get((task_id, reg_id), 0) + n
+
+    def remove(self, task_id, reg_id, robot_id, n=1):
+        """
+        robot对子任务(task, reg)减少n次采样，采样次数减为0的分配被删除（由最后一行填补）
+        """
+        key = (task_id, reg_id, robot_id)
+        row = self.key_index[key]
+        if n > self.__count[row]:
+            raise ValueError(f"cannot remove {n} samples from {key}, only {self.__count[row]} allocated")
+        self.__count[row] -= n
+        self.__samples[task_id, reg_id] -= n
+        if not self.__samples[task_id, reg_id]:
+            del self.__samples[task_id, reg_id]
+        if self.__count[row]:
+            return
+        del self.key_index[key]
+        last = self.__size - 1
+        if row != last:
+            for array in (self.__task, self.__reg, self.__robot, self.__count):
+                array[row] = array[last]
+            self.key_index[int(self.__task[row]), int(self.__reg[row]), int(self.__robot[row])] = row
+        self.__size = last
+
+    def __grow(self):
+        capacity = max(1, 2 * len(self.__count))
+        for name in ("task", "reg", "robot", "count"):
+            attr = f"_AllocationPlan__{name}"
+            array = np.zeros(capacity, dtype=np.int64)
+            array[:self.__size] = getattr(self, attr)[:self.__size]
+            setattr(self, attr, array)
+
+    """ sample counters """
+
+    def samples(self, task_id, reg_id) -> int:
+        return self.__samples.get((task_id, reg_id), 0)
+
+    @property
+    def sample_record(self):
+        """
+        (task.id, reg.id) -> 采样次数 的只读视图
+        """
+        return types.MappingProxyType(self.__samples)
+
+    """ statistics """
+
+    def export(self) -> Dict[str, np.ndarray]:
+        """
+        导出COO数组（副本），可以直接用于np.savez或pandas.DataFrame
+        """
+        size = self.__size
+        return {"task": self.__task[:size].copy(), "reg": self.__reg[:size].copy(),
+                "robot": self.__robot[:size].copy(), "count": self.__count[:size].copy()}
+
+    def taskSamples(self, task_ids: Sequence[int], robot_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        每个任务的总采样次数
+        :param robot_ids: 若给出，只统计这些机器人的分配
+        """
+        weights = self.__count[:self.__size]
+        if robot_ids is not None:
+            weights = np.where(np.isin(self.__robot[:self.__size], np.asarray(robot_ids, dtype=np.int64)), weights, 0)
+        return self.__aggregate(self.__task[:self.__size], task_ids, weights)
+
+    def robotLoad(self, robot_ids: Sequence[int]) -> np.ndarray:
+        """
+        每个机器人被分配的采样次数
+        """
+        return self.__aggregate(self.__robot[:self.__size], robot_ids, self.__count[:self.__size])
+
+    def taskCompletion(self, task_ids: Sequence[int], subtask_nums: Sequence[int], gamma,
+                       robot_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        每个任务的分配完成度：总采样次数 / 子任务数 / gamma
+        """
+        return self.taskSamples(task_ids, robot_ids) / np.asarray(subtask_nums) / gamma
+
+    @staticmethod
+    def __aggregate(column: np.ndarray, ids: Sequence[int], weights: np.ndarray) -> np.ndarray:
+        # 按ids的顺序对column中相同id的weights求和，不在ids中的行被忽略
+        ids = np.asarray(ids, dtype=np.int64)
+        result = np.zeros(len(ids), dtype=np.int64)
+        if not len(ids) or not len(column):
+            return result
+        order = np.argsort(ids, kind="stable")
+        sorted_ids = ids[order]
+        pos = np.minimum(np.searchsorted(sorted_ids, column), len(ids) - 1)
+        valid = sorted_ids[pos] == column
+        np.add.at(result, order[pos[valid]], weights[valid])
+        return result
@@ -1,3 +1,7 @@
+from typing import List
+
+import numpy as np
+
 from robot import RobotCategory
 from senseArea import Region, EuclideanDistance, ManhattanDistance, Point
 
@@ -12,6 +16,13 @@ class UAV(RobotCategory):
     def interD(self, reg1: Region, reg2: Region) -> float:
         return EuclideanDistance(reg1.represent_loc, reg2.represent_loc)
 
+    def interDTable(self, regions: List[Region]) -> np.ndarray:
+        loc = np.array([reg.represent_loc for reg in regions], dtype=float)
+        # float_power与EuclideanDistance中的**2一样调用pow，结果逐位相同
+        dx = np.float_power(loc[:, None, 0] - loc[None, :, 0], 2)
+        dx += np.float_power(loc[:, None, 1] - loc[None, :, 1], 2)
+        return np.sqrt(dx, out=dx)
+
     def intraD(self, reg: Region) -> float:
         return 2 * sum(reg.len) * self.intra_factor
 
@@ -34,6 +45,12 @@ class UV(RobotCategory):
     def interD(self, reg1: Region, reg2: Region) -> float:
         return ManhattanDistance(reg1.represent_loc, reg2.represent_loc)
 
+    def interDTable(self, regions: List[Region]) -> np.ndarray:
+        loc = np.array([reg.represent_loc for reg in regions], dtype=float)
+        d = np.abs(loc[:, None, 0] - loc[None, :, 0])
+        d += np.abs(loc[:, None, 1] - loc[None, :, 1])
+        return d
+
     def intraD(self, reg: Region) -> float:
         return 2 * sum(reg.len) * self.intra_factor
 
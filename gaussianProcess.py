@@ -0,0 +1,225 @@
+import itertools
+from typing import Sequence, Tuple
+
+import numpy as np
+from scipy import linalg
+
+from mapKernel import MaternKernel
+
+
+def inducingPoints(kernel: MaternKernel, grid_size, num=None, spacing=0.75) -> np.ndarray:
+    """
+    在感知图上均匀选取诱导点，保留全部机器人类别（类别之间的距离远大于核的长度尺度）
+    :param grid_size: 感知区域网格的(行数, 列数)，区域id为 行 * 列数 + 列
+    :param num: None时按核的长度尺度选取：区域与时间段在每一维上的间隔不超过 spacing * PHO，
+                诱导点数目只取决于PHO与感知区域、时间周期的相对大小；
+                给出num时选取约num个点，诱导点间隔大于长度尺度时后验均值会明显偏离精确高斯过程
+    :return: 形如(m, 3)的(reg, ts, rc)下标
+    """
+    ts_num, rc_num = len(kernel.ts_dist), len(kernel.rc_dist)
+    if num is None:
+        def axis(n, step):
+            # 相邻诱导点之间相隔k个网格，在该维上居中
+            k = max(1, int(spacing * kernel.PHO / step)) if n > 1 else 1
+            return np.arange((n - 1) % k // 2, n, k)
+        xs = axis(grid_size[0], kernel.reg_dist[0, grid_size[1]] if grid_size[0] > 1 else 1)
+        ys = axis(grid_size[1], kernel.reg_dist[0, 1] if grid_size[1] > 1 else 1)
+        tss = axis(ts_num, kernel.ts_dist[0, 1] if ts_num > 1 else 1)
+    else:
+        per_rc = max(1, num // rc_num)
+        ts_sample = min(ts_num, max(1, round(per_rc ** 0.5 / 2)))
+        side = max(1, int((per_rc // ts_sample) ** 0.5))
+        xs = np.unique(np.linspace(0, grid_size[0] - 1, min(side, grid_size[0])).round().astype(int))
+        ys = np.unique(np.linspace(0, grid_size[1] - 1, min(side, grid_size[1])).round().astype(int))
+        tss = np.unique(np.linspace(0, ts_num - 1, ts_sample).round().astype(int))
+    regs = (xs[:, None] * grid_size[1] + ys[None, :]).ravel()
+    return np.array(list(itertools.product(regs, tss, range(rc_num))))
+
+
+class ExactGP:
+    """
+    精确高斯过程回归。
+    维护历史点协方差 K + noise*I = L D L^T 的无开方Cholesky分解（L为单位下三角，D为对角）以及 z = L^{-1} y，
+    每新增一个历史点只需一次三角求解对L做秩1扩展，代价为O(n^2)，无需重新求逆。
+    注意：Matern核作用在曼哈顿距离、环形距离与类别差异之和上，并不保证K半正定，
+    因此不使用普通的Cholesky分解（K+noise*I不正定时会失败），LDL^T分解在K正定时与之等价。
+    """
+
+    def __init__(self, kernel: MaternKernel, noise):
+        self.kernel = kernel
+        self.noise = noise
+        self.points = np.empty((0, 3), dtype=int)
+        self.__L = np.empty((0, 0))
+        self.__d = np.empty(0)
+        self.__z = np.empty(0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def reset(self):
+        self.points = np.empty((0, 3), dtype=int)
+        self.__L = np.empty((0, 0))
+        self.__d = np.empty(0)
+        self.__z = np.empty(0)
+
+    def append(self, point: Sequence[int], y: float):
+        """
+        新增一个历史点，对分解做秩1扩展:
+            L_new = [[L,   0],    D_new = diag(D, d)
+                     [l^T, 1]]
+        其中 w = L^{-1} k，l = D^{-1} w，d = k(x, x) + noise - w^T D^{-1} w
+        """
+        point = np.asarray(point, dtype=int).reshape(1, 3)
+        n = len(self.points)
+
+        k = self.kernel.block(self.points, point)[:, 0]
+        w = linalg.solve_triangular(self.__L, k, lower=True, unit_diagonal=True) if n else k
+        l = w / self.__d
+        d = self.kernel.diag(point)[0] + self.noise - np.dot(w, l)
+        if d == 0:
+            raise np.linalg.LinAlgError("singular covariance matrix")
+
+        factor = np.eye(n + 1)
+        factor[:n, :n] = self.__L
+        factor[n, :n] = l
+        self.__L = factor
+        self.__d = np.append(self.__d, d)
+        self.__z = np.append(self.__z, y - np.dot(l, self.__z))
+        self.points = np.concatenate((self.points, point))
+
+    def extend(self, points: Sequence, ys: Sequence[float]):
+        for point, y in zip(points, ys):
+            self.append(point, y)
+
+    def predict(self, points: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        points处的后验
+        :return: (均值, 方差)，均值为相对先验的偏移
+        """
+        points = np.asarray(points, dtype=int).reshape(-1, 3)
+        return self.__posterior(self.kernel.block(points, self.points), self.kernel.diag(points))
+
+    def predictGrid(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        感知图中所有点的后验，返回数组形状为(reg, ts, rc)
+        """
+        return self.__posterior(self.kernel.grid(self.points), self.kernel.gridDiag())
+
+    def __posterior(self, k_star: np.ndarray, k_diag: np.ndarray):
+        # k_star的最后一维对应历史点
+        # mean = k^T K^{-1} y = v^T D^{-1} z,  var = k(x, x) - v^T D^{-1} v,  其中 v = L^{-1} k
+        shape = k_star.shape[:-1]
+        if not len(self.points):
+            return np.zeros(shape), k_diag
+        v = linalg.solve_triangular(self.__L, k_star.reshape(-1, len(self.points)).T,
+                                    lower=True, unit_diagonal=True)
+        mean = np.dot(self.__z / self.__d, v).reshape(shape)
+        var = k_diag - np.dot(1 / self.__d, v * v).reshape(shape)
+        return mean, var
+
+
+class SparseGP:
+    """
+    基于诱导点(inducing points)的近似高斯过程(DTC)。
+    Matern核在此处的距离上不保证半正定，K_mm可能有负特征值，直接求逆会使后验发散，因此先做特征分解
+        K_mm = U diag(lam) U^T
+    只保留 lam > eig_tol * max(lam) 的方向，得到半正定的低秩近似，并把诱导点特征白化为
+        phi(x) = diag(lam)^{-1/2} U^T k_m(x)
+    此时 k_xm K_mm^+ k_mx = phi(x)^T phi(x)，DTC等价于先验为单位阵的贝叶斯线性回归。
+    历史点只通过充分统计量进入模型:
+        B = sum phi(x_i) phi(x_i)^T,    b = sum phi(x_i) y_i
+    每新增一个历史点的代价为O(m^2)，内存与历史点数目无关，总代价随历史点数目线性增长。
+    后验（A = I + B / noise 对称正定，用Cholesky分解求解而不求逆）:
+        mean(x) = phi(x)^T A^{-1} b / noise
+        var(x)  = k(x, x) - phi(x)^T phi(x) + phi(x)^T A^{-1} phi(x)，截断在0以上
+    """
+
+    # 分块计算后验时，每块(感知点数 * 诱导点数)的上限
+    CHUNK = 1 << 22
+
+    def __init__(self, kernel: MaternKernel, noise, inducing_points: Sequence, eig_tol=1e-6):
+        self.kernel = kernel
+        self.noise = noise
+        self.inducing = np.asarray(inducing_points, dtype=int).reshape(-1, 3)
+        lam, u = linalg.eigh(self.kernel.block(self.inducing, self.inducing))
+        keep = lam > eig_tol * lam.max()
+        # k_m(x) -> phi(x) 的投影，形状为(m, rank)
+        self.__projection = u[:, keep] / np.sqrt(lam[keep])
+        rank = self.__projection.shape[1]
+        self.__B = np.zeros((rank, rank))
+        self.__b = np.zeros(rank)
+        self.__n = 0
+        self.__weights = None
+
+    def __len__(self):
+        return self.__n
+
+    @property
+    def rank(self):
+        return len(self.__b)
+
+    def reset(self):
+        self.__B[...] = 0
+        self.__b[...] = 0
+        self.__n = 0
+        self.__weights = None
+
+    def append(self, point: Sequence[int], y: float):
+        self.extend([point], [y])
+
+    def extend(self, points: Sequence, ys: Sequence[float]):
+        phi = np.dot(self.__projection.T, self.kernel.block(self.inducing, points))
+        self.__B += np.dot(phi, phi.T)
+        self.__b += np.dot(phi, np.asarray(ys, dtype=float))
+        self.__n += phi.shape[1]
+        self.__weights = None
+
+    def __solve(self):
+        # 只有新增历史点后才需要重新求解
+        if self.__weights is None:
+            factor = linalg.cholesky(np.eye(self.rank) + self.__B / self.noise, lower=True)
+            weights = linalg.cho_solve((factor, True), self.__b) / self.noise
+            self.__weights = weights, factor
+        return self.__weights
+
+    def predict(self, points: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        points处的后验，与predictGrid相同，分块计算，避免一次生成(len(points), m)的核矩阵
+        :return: (均值, 方差)，均值为相对先验的偏移
+        """
+        points = np.asarray(points, dtype=int).reshape(-1, 3)
+        step = max(1, self.CHUNK // max(1, len(self.inducing)))
+        mean = np.empty(len(points))
+        var = np.empty(len(points))
+        for start in range(0, len(points), step):
+            block = points[start:start + step]
+            mean[start:start + step], var[start:start + step] = self.__posterior(
+                self.kernel.block(block, self.inducing), self.kernel.diag(block))
+        return mean, var
+
+    def predictGrid(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        感知图中所有点的后验，返回数组形状为(reg, ts, rc)
+        按区域分块计算，避免一次生成(cells, m)的核矩阵
+        """
+        reg_num, ts_num, rc_num = (len(self.kernel.reg_dist), len(self.kernel.ts_dist), len(self.kernel.rc_dist))
+        step = max(1, self.CHUNK // (ts_num * rc_num * max(1, len(self.inducing))))
+        mean = np.empty((reg_num, ts_num, rc_num))
+        var = np.empty((reg_num, ts_num, rc_num))
+        for start in range(0, reg_num, step):
+            regs = slice(start, start + step)
+            mean[regs], var[regs] = self.__posterior(self.kernel.grid(self.inducing, regs),
+                                                     self.kernel.gridDiag(regs))
+        return mean, var
+
+    def __posterior(self, k_star: np.ndarray, k_diag: np.ndarray):
+        # k_star的最后一维对应诱导点，转为二维后再做矩阵乘法
+        shape = k_star.shape[:-1]
+        if not self.__n:
+            return np.zeros(shape), k_diag
+        weights, factor = self.__solve()
+        phi = np.dot(k_star.reshape(-1, len(self.inducing)), self.__projection)
+        mean = np.dot(phi, weights).reshape(shape)
+        v = linalg.solve_triangular(factor, phi.T, lower=True)
+        var = k_diag - ((phi * phi).sum(axis=-1) - (v * v).sum(axis=0)).reshape(shape)
+        return mean, np.maximum(var, 0)
@@ -0,0 +1,251 @@
+import collections
+from typing import Callable, Hashable, List, Sequence
+
+import numpy as np
+
+from senseArea import Region
+from task import TimeSlot
+from robot import RobotCategory
+
+
+CacheInfo = collections.namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+class KernelCache:
+    """
+    有界的核缓存。由拥有它的对象持有，随之一同释放，不会像类级别的lru_cache那样永久持有实例。
+    policy:
+        "lru":  淘汰最久未使用的项
+        "fifo": 淘汰最早加入的项
+    """
+
+    def __init__(self, maxsize=32, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"unknown cache policy {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.__data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key: Hashable, compute: Callable):
+        if key in self.__data:
+            self.hits += 1
+            if self.policy == "lru":
+                self.__data.move_to_end(key)
+            return self.__data[key]
+        self.misses += 1
+        value = compute()
+        self.__put(key, value)
+        return value
+
+    def getMany(self, keys: Sequence[Hashable], compute: Callable) -> list:
+        """
+        批量查询，未命中的项由一次compute(未命中的keys)求出
+        :param compute: 接收未命中的keys（不重复），返回与之一一对应的值
+        :return: 与keys一一对应的值
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in found:
+                self.hits += 1
+            elif key in self.__data:
+                self.hits += 1
+                if self.policy == "lru":
+                    self.__data.move_to_end(key)
+                found[key] = self.__data[key]
+            else:
+                self.misses += 1
+                found[key] = None
+                missing.append(key)
+        if missing:
+            for key, value in zip(missing, compute(missing)):
+                found[key] = value
+                self.__put(key, value)
+        return [found[key] for key in keys]
+
+    def __put(self, key: Hashable, value):
+        if self.maxsize > 0:
+            if len(self.__data) >= self.maxsize:
+                self.__data.popitem(last=False)
+            self.__data[key] = value
+
+    def clear(self):
+        self.__data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.__data))
+
+
+class MaternKernel:
+    """
+    SenseMap使用的Matern(v=5/2)核。
+    两个感知点之间的距离由区域、时间段、机器人类别三部分加权求和，三部分均可预先计算成距离表：
+        reg_dist[i, j]: 区域中心的曼哈顿距离 / 感知区域对角线
+        ts_dist[i, j]:  时间段的环形距离 / 时间段数目
+        rc_dist[i, j]:  机器人类别的dissimilarity
+    之后任意一组感知点之间的核矩阵都可以用numpy广播一次求出。
+    整张感知图与某一点之间的核(grid的一列)会被缓存在cache中，历史点在多次update之间无需重复计算。
+    """
+
+    SQRT5 = 2.236067977
+
+    def __init__(self,
+                 regions: List[Region],
+                 time_slots: List[TimeSlot],
+                 robot_categories: List[RobotCategory],
+                 area_max_dist,
+                 pho,
+                 factor=(1, 1, 1),
+                 cache_size=32,
+                 cache_policy="lru"):
+        self.PHO = pho
+        self.cache = KernelCache(cache_size, cache_policy)
+        weight = [f / sum(factor) for f in factor]
+
+        centers = np.array([reg.center for reg in regions], dtype=float)
+        manhattan = np.abs(centers[:, None, :] - centers[None, :, :]).sum(axis=-1)
+        self.reg_dist = weight[0] * manhattan / area_max_dist
+
+        ts_num = len(time_slots)
+        ts_ids = np.array([ts.id for ts in time_slots])
+        diff = np.abs(ts_ids[:, None] - ts_ids[None, :])
+        self.ts_dist = weight[1] * np.minimum(diff, ts_num - diff) / ts_num
+
+        self.rc_dist = weight[2] * np.array([[rc1.dissimilarity(rc2) for rc2 in robot_categories]
+                                             for rc1 in robot_categories])
+
+    def matern(self, d: np.ndarray) -> np.ndarray:
+        # (1 + x + 5d^2 / (3pho^2)) * exp(-x)，x = sqrt5 * d / pho
+        # 运算顺序与直接写出的表达式相同，但原地计算，整张感知图大小的临时数组更少
+        d = np.minimum(d, 1)
+        x = d * self.SQRT5
+        x /= self.PHO
+        k = 5 * d
+        k *= d
+        k /= 3 * self.PHO * self.PHO
+        k += 1 + x
+        x *= -1
+        k *= np.exp(x)
+        return k
+
+    def distance(self, regs, tss, rcs, regs2, tss2, rcs2) -> np.ndarray:
+        """
+        两组感知点之间的归一化距离，参数为下标数组，按numpy规则广播
+        """
+        return self.reg_dist[regs, regs2] + self.ts_dist[tss, tss2] + self.rc_dist[rcs, rcs2]
+
+    def block(self, points1: Sequence, points2: Sequence) -> np.ndarray:
+        """
+        核矩阵 K[a, b] = k(points1[a], points2[b])
+        :param points1: 形如(n, 3)的(reg, ts, rc)下标
+        :param points2: 形如(m, 3)的(reg, ts, rc)下标
+        :return: (n, m)矩阵
+        """
+        p1 = np.asarray(points1, dtype=int).reshape(-1, 3)
+        p2 = np.asarray(points2, dtype=int).reshape(-1, 3)
+        return self.matern(self.distance(p1[:, 0, None], p1[:, 1, None], p1[:, 2, None],
+                                         p2[None, :, 0], p2[None, :, 1], p2[None, :, 2]))
+
+    def diag(self, points: Sequence) -> np.ndarray:
+        """
+        points中每一点与自身的核
+        """
+        p = np.asarray(points, dtype=int).reshape(-1, 3)
+        return self.matern(self.distance(p[:, 0], p[:, 1], p[:, 2], p[:, 0], p[:, 1], p[:, 2]))
+
+    def grid(self, points: Sequence, regs=slice(None)) -> np.ndarray:
+        """
+        感知图中每一点与points之间的核
+        :param regs: 只计算这些区域（下标数组或切片），默认全部区域
+        :return: 形状为(reg, ts, rc, len(points))的数组
+        """
+        p = np.asarray(points, dtype=int).reshape(-1, 3)
+        if isinstance(regs, slice) and regs == slice(None) and self.cache.maxsize > 0:
+            if not len(p):
+                return np.empty((len(self.reg_dist), len(self.ts_dist), len(self.rc_dist), 0))
+            # 未命中的点用一次__grid求出
+            return np.stack(self.cache.getMany(list(map(tuple, p.tolist())), self.__columns), axis=-1)
+        return self.__grid(p, regs)
+
+    def __columns(self, points: List[tuple]) -> List[np.ndarray]:
+        # 与__grid相同，但以points为第一维，每一列连续存放，复制为独立的数组后缓存中的列不会保留整块结果
+        p = np.array(points)
+        d = self.reg_dist[p[:, 0]][:, :, None, None] \
+            + self.ts_dist[p[:, 1]][:, None, :, None] \
+            + self.rc_dist[p[:, 2]][:, None, None, :]
+        return [column.copy() for column in self.matern(d)]
+
+    def __grid(self, p: np.ndarray, regs) -> np.ndarray:
+        d = self.reg_dist[regs][:, p[:, 0]][:, None, None, :] \
+            + self.ts_dist[:, p[:, 1]][None, :, None, :] \
+            + self.rc_dist[:, p[:, 2]][None, None, :, :]
+        return self.matern(d)
+
+    def gridDiag(self, regs=slice(None)) -> np.ndarray:
+        """
+        感知图中每一点与自身的核，即先验方差
+        """
+        d = np.diag(self.reg_dist)[regs][:, None, None] \
+            + np.diag(self.ts_dist)[None, :, None] \
+            + np.diag(self.rc_dist)[None, None, :]
+        return self.matern(d)
+
+
+class NeighborhoodIndex:
+    """
+    核的紧支撑近邻索引。
+    Matern核随距离单调递减，核值大于tol等价于距离小于d_tol；而距离是区域、时间段、类别三部分之和，
+    因此可以先在每一维上按 dist < d_tol 筛选候选下标，再在候选的乘积上精确判断。
+    """
+
+    def __init__(self, kernel: MaternKernel, tol):
+        self.kernel = kernel
+        self.tol = tol
+        self.d_tol = self.__cutoff()
+        self.reg_near = [np.flatnonzero(row < self.d_tol) for row in kernel.reg_dist]
+        self.ts_near = [np.flatnonzero(row < self.d_tol) for row in kernel.ts_dist]
+        self.rc_near = [np.flatnonzero(row < self.d_tol) for row in kernel.rc_dist]
+
+    def __cutoff(self, iterations=60):
+        # 二分求解 matern(d) = tol，距离被截断在1，因此d_tol不超过1
+        if self.kernel.matern(np.float64(1)) > self.tol:
+            return np.inf
+        low, high = 0.0, 1.0
+        for _ in range(iterations):
+            mid = (low + high) / 2
+            if self.kernel.matern(np.float64(mid)) > self.tol:
+                low = mid
+            else:
+                high = mid
+        return high
+
+    def near(self, point: Sequence[int]) -> np.ndarray:
+        """
+        与point的核值大于tol的感知点
+        :return: 形如(n, 3)的(reg, ts, rc)下标
+        """
+        reg, ts, rc = point
+        regs, tss, rcs = self.reg_near[reg], self.ts_near[ts], self.rc_near[rc]
+        d = self.kernel.reg_dist[reg, regs][:, None, None] \
+            + self.kernel.ts_dist[ts, tss][None, :, None] \
+            + self.kernel.rc_dist[rc, rcs][None, None, :]
+        i, j, k = np.nonzero(d < self.d_tol)
+        return np.stack((regs[i], tss[j], rcs[k]), axis=-1)
+
+    def mask(self, points: Sequence, shape) -> np.ndarray:
+        """
+        points近邻的并集
+        :return: 形状为shape的布尔数组
+        """
+        mask = np.zeros(shape, dtype=bool)
+        for point in points:
+            i, j, k = self.near(point).T
+            mask[i, j, k] = True
+        return mask
@@ -0,0 +1,276 @@
+"""
+感知图先验的二进制存储格式(.smap)
+
+    | magic(8B) | version(u32) | reg(u32) | ts(u32) | rc(u32) | grid_x(u32) | grid_y(u32) | padding | data |
+
+头部固定为HEADER_SIZE字节，之后为形状(reg, ts, rc)、C顺序、小端float64的先验数组，
+因此可以直接用np.memmap打开，多个进程共享同一份只读先验而无需复制。
+
+感知图增量日志(DeltaLog)
+    dump_path/base.smap: 第一个更新周期之前的先验
+    dump_path/delta.log: | magic(8B) | version(u32) | reg(u32) | ts(u32) | rc(u32) | padding | records |
+每个更新周期只追加被修改的感知点(cycle, cell, value)，cell为感知点在(reg, ts, rc)数组中的扁平下标。
+materializeCycle按顺序重放日志即可得到任意周期的先验，与该周期的{cycle}.mapdata相同。
+"""
+
+import collections
+import os
+import pickle
+import queue
+import struct
+import sys
+import threading
+import weakref
+from typing import Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"CSPYMAP\0"
+VERSION = 1
+HEADER_SIZE = 64
+DTYPE = np.dtype("<f8")
+
+DELTA_MAGIC = b"CSPYDLT\0"
+DELTA_DTYPE = np.dtype([("cycle", "<u4"), ("cell", "<u8"), ("value", "<f8")])
+BASE_FILE = "base.smap"
+DELTA_FILE = "delta.log"
+
+_HEADER = struct.Struct("<8s6I")
+_DELTA_HEADER = struct.Struct("<8s4I")
+
+MapHeader = collections.namedtuple("MapHeader", "version size grid_size")
+
+
+def writeHeader(fp, size, grid_size):
+    header = _HEADER.pack(MAGIC, VERSION, *size, *grid_size)
+    fp.write(header.ljust(HEADER_SIZE, b"\0"))
+
+
+def readHeader(filename) -> MapHeader:
+    with open(filename, 'rb') as fp:
+        raw = fp.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE or not raw.startswith(MAGIC):
+        raise ValueError(f"{filename} is not a sense map file")
+    magic, version, reg, ts, rc, grid_x, grid_y = _HEADER.unpack_from(raw)
+    if version != VERSION:
+        raise ValueError(f"unsupported sense map version {version} in {filename}")
+    return MapHeader(version, (reg, ts, rc), (grid_x, grid_y))
+
+
+def isMapFile(filename) -> bool:
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def writeMap(filename, prior: np.ndarray, grid_size):
+    """
+    写入.smap文件，先写临时文件再替换，读者不会看到写了一半的文件
+    """
+    tmp = f"{filename}.tmp"
+    with open(tmp, 'wb') as fp:
+        writeHeader(fp, prior.shape, grid_size)
+        fp.write(np.ascontiguousarray(prior, dtype=DTYPE).tobytes())
+    os.replace(tmp, filename)
+
+
+def openMap(filename, mode='r', size: Optional[Tuple[int, int, int]] = None) -> np.memmap:
+    """
+    以np.memmap打开.smap文件
+    :param mode: 'r'只读共享；'c'写时复制，修改只在本进程可见；'r+'直接修改文件
+    :param size: 若给出，则检查文件中的感知图大小
+    """
+    header = readHeader(filename)
+    if size is not None and tuple(size) != header.size:
+        raise ValueError(f"sense map size {header.size} in {filename} does not match {tuple(size)}")
+    return np.memmap(filename, dtype=DTYPE, mode=mode, offset=HEADER_SIZE, shape=header.size)
+
+
+def writeMapData(filename, prior: np.ndarray):
+    """
+    写入旧的.mapdata格式，即Dict[MapPoint, float]的pickle
+    """
+    from senseMap import MapPoint
+    prior_map = {MapPoint(*key): value.item() for key, value in np.ndenumerate(prior)}
+    with open(filename, 'wb') as fp:
+        pickle.dump(prior_map, fp)
+
+
+def convertMapData(src, dst, grid_size, size=None):
+    """
+    将旧的.mapdata(Dict[MapPoint, float]的pickle)转换为.smap
+    :param size: 感知图大小，默认由MapPoint的最大下标推断
+    """
+    with open(src, 'rb') as fp:
+        prior_map = pickle.load(fp)
+    if size is None:
+        size = tuple(max(key[i] for key in prior_map) + 1 for i in range(3))
+    prior = np.zeros(size)
+    for key, value in prior_map.items():
+        prior[tuple(key)] = value
+    writeMap(dst, prior, grid_size)
+
+
+class DeltaLog:
+    """
+    只追加的感知图增量日志，记录写入带缓冲的文件，缓冲区满、flush()或close()时落盘
+    """
+
+    def __init__(self, path, prior: np.ndarray, grid_size, buffer_size=1 << 16):
+        if not os.path.exists(path):
+            os.mkdir(path)
+        self.path = path
+        self.size = prior.shape
+        writeMap(os.path.join(path, BASE_FILE), prior, grid_size)
+
+        self.__fp = open(os.path.join(path, DELTA_FILE), 'wb', buffering=buffer_size)
+        header = _DELTA_HEADER.pack(DELTA_MAGIC, VERSION, *self.size)
+        self.__fp.write(header.ljust(HEADER_SIZE, b"\0"))
+        # 对象被回收或解释器退出时也会关闭文件，保证缓冲区中的记录落盘
+        self.__finalizer = weakref.finalize(self, self.__fp.close)
+
+    def append(self, cycle, cells, values):
+        records = np.empty(len(cells), dtype=DELTA_DTYPE)
+        records["cycle"] = cycle
+        records["cell"] = cells
+        records["value"] = values
+        self.__fp.write(records.tobytes())
+
+    def flush(self):
+        self.__fp.flush()
+
+    def close(self):
+        self.__finalizer()
+
+    @property
+    def closed(self):
+        return not self.__finalizer.alive
+
+
+def readDelta(path) -> np.ndarray:
+    filename = os.path.join(path, DELTA_FILE)
+    with open(filename, 'rb') as fp:
+        raw = fp.read(HEADER_SIZE)
+        if len(raw) < HEADER_SIZE or not raw.startswith(DELTA_MAGIC):
+            raise ValueError(f"{filename} is not a sense map delta log")
+        magic, version, *size = _DELTA_HEADER.unpack_from(raw)
+        if version != VERSION:
+            raise ValueError(f"unsupported delta log version {version} in {filename}")
+        data = fp.read()
+    # 忽略进程中断时可能写了一半的最后一条记录
+    usable = len(data) // DELTA_DTYPE.itemsize * DELTA_DTYPE.itemsize
+    return np.frombuffer(data[:usable], dtype=DELTA_DTYPE)
+
+
+def materializeCycle(path, cycle=None) -> np.ndarray:
+    """
+    重放增量日志，得到第cycle个更新周期结束后的先验
+    :param cycle: 默认为日志中的最后一个周期
+    """
+    prior = np.array(openMap(os.path.join(path, BASE_FILE)))
+    records = readDelta(path)
+    if cycle is not None:
+        records = records[records["cycle"] <= cycle]
+    # 同一感知点以最后一条记录为准
+    cells = records["cell"][::-1]
+    cells, index = np.unique(cells, return_index=True)
+    prior.flat[cells] = records["value"][::-1][index]
+    return prior
+
+
+def compact(path, cycle=None, dst=None):
+    """
+    将增量日志物化为某一周期的.smap文件
+    :return: 写出的文件名
+    """
+    if cycle is None:
+        records = readDelta(path)
+        cycle = int(records["cycle"].max()) if len(records) else 0
+    if dst is None:
+        dst = os.path.join(path, f"{cycle}.smap")
+    grid_size = readHeader(os.path.join(path, BASE_FILE)).grid_size
+    writeMap(dst, materializeCycle(path, cycle), grid_size)
+    return dst
+
+
+class DumpError(Exception):
+    """
+    background dump error
+    """
+
+
+class MapWriter:
+    """
+    后台写线程。写任务进入有界队列，由单独的线程依次执行，调用者只需提供数据的快照。
+    - 背压：队列满时submit()阻塞，超过timeout则抛出queue.Full；pending为尚未完成的任务数
+    - 错误：写任务的异常记录在errors中，并在下一次submit()、flush()或close()时以DumpError抛出
+    """
+
+    def __init__(self, max_pending=4, timeout=None):
+        self.timeout = timeout
+        self.errors = []
+        self.__reported = 0
+        self.__queue = queue.Queue(max_pending)
+        self.__thread = threading.Thread(target=self.__run, name="SenseMapWriter", daemon=True)
+        self.__thread.start()
+
+    @property
+    def pending(self):
+        return self.__queue.unfinished_tasks
+
+    @property
+    def closed(self):
+        return not self.__thread.is_alive()
+
+    def submit(self, func, *args):
+        if self.closed:
+            raise DumpError("MapWriter is closed")
+        self.check()
+        self.__queue.put((func, args), timeout=self.timeout)
+
+    def check(self):
+        """
+        抛出上次检查之后发生的写错误
+        """
+        if len(self.errors) > self.__reported:
+            error = self.errors[self.__reported]
+            self.__reported = len(self.errors)
+            raise DumpError(f"background dump failed: {error!r}") from error
+
+    def flush(self):
+        self.__queue.join()
+        self.check()
+
+    def close(self):
+        if not self.closed:
+            self.__queue.put(None)
+            self.__thread.join()
+        self.check()
+
+    def __run(self):
+        while True:
+            job = self.__queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                # 不再持有任务及其数据的引用
+                job = func = args = None
+                self.__queue.task_done()
+
+
+if __name__ == '__main__':
+    # python mapStorage.py convert src.mapdata dst.smap grid_x grid_y
+    # python mapStorage.py compact dump_path [cycle]
+    if len(sys.argv) == 6 and sys.argv[1] == "convert":
+        convertMapData(sys.argv[2], sys.argv[3], (int(sys.argv[4]), int(sys.argv[5])))
+        print(readHeader(sys.argv[3]))
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "compact":
+        print(compact(sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else None))
+    else:
+        print("usage: python mapStorage.py convert src.mapdata dst.smap grid_x grid_y\n"
+              "       python mapStorage.py compact dump_path [cycle]")
+        sys.exit(1)
@@ -1,8 +1,11 @@
+import collections
 import functools
 import numbers
 from abc import ABC, abstractmethod
 from typing import List, Optional
 
+import numpy as np
+
 from senseArea import Region, EuclideanDistance, Point
 from sensor import Sensor
 from RobotState import IdleState, MovingState, SensingState, BrokenState
@@ -22,6 +25,12 @@ def dataDiff(data1, data2):
         raise NotImplementedError(type(data1))
 
 
+PlanSuffix = collections.namedtuple(
+    "PlanSuffix", "planned_distance finish_time ideal_time_used ideal_moving_time ideal_sensing_time")
+
+DistanceTables = collections.namedtuple("DistanceTables", "regions inter_d intra_d sensing_time")
+
+
 class RobotCategory(ABC):
 
     def __init__(self, rc_id, category, sensors, move_mode, v, physical_property):
@@ -31,6 +40,9 @@ class RobotCategory(ABC):
         self.move_mode: str = move_mode
         self.v: float = v
         self.physical_property: dict = physical_property
+        self.__tables: Optional[DistanceTables] = None
+        # (所需传感器类别, 精度) -> 此类机器人可用的传感器
+        self.__adequate_sensors = {}
 
     def __hash__(self):
         """
@@ -54,6 +66,72 @@ class RobotCategory(ABC):
         cls = type(self)
         return f"{cls.__name__}(id:{self.id}, category:{self.category}, move mode:{self.move_mode})"
 
+    def __getstate__(self):
+        # 距离表可以由网格重新生成，复制对象（例如发送到进程池）时不携带
+        state = self.__dict__.copy()
+        state['_RobotCategory__tables'] = None
+        return state
+
+    def adequateSensors(self, task: Task) -> tuple:
+        """
+        此类机器人可以用于task的传感器，只取决于task所需的传感器，因此只计算一次
+        """
+        required = task.requiredSensor
+        key = (required.category, required.accuracy)
+        if key not in self.__adequate_sensors:
+            self.__adequate_sensors[key] = tuple(set(filter(task.adequateSensor, self.sensors)))
+        return self.__adequate_sensors[key]
+
+    """ distance tables """
+
+    def buildTables(self, regions: List[Region]):
+        """
+        预先计算此类机器人在网格regions上的距离表，regions[i].id应为i
+            inter_d[i, j]:   区域i到区域j的移动距离，移动时间为inter_d / v
+            intra_d[i]:      在区域i内执行感知任务的移动距离
+            sensing_time[i]: 在区域i内执行感知任务的时间
+        """
+        inter_d = self.interDTable(regions)
+        intra_d = np.array([self.intraD(reg) for reg in regions], dtype=float)
+        self.__tables = DistanceTables(regions, inter_d, intra_d, intra_d / self.v)
+
+    def interDTable(self, regions: List[Region]) -> np.ndarray:
+        """
+        inter_d[i, j] = interD(regions[i], regions[j])，子类可以用向量化的实现覆盖
+        """
+        return np.array([[self.interD(reg1, reg2) for reg2 in regions] for reg1 in regions], dtype=float)
+
+    @property
+    def tables(self) -> Optional[DistanceTables]:
+        return self.__tables
+
+    def __onGrid(self, reg: Region) -> bool:
+        regions = self.__tables.regions
+        return reg.id < len(regions) and regions[reg.id] is reg
+
+    def gridInterD(self, reg1: Region, reg2: Region) -> float:
+        """
+        查表得到的interD，区域不属于已建表的网格时直接计算
+        """
+        if self.__tables is not None and self.__onGrid(reg1) and self.__onGrid(reg2):
+            return self.__tables.inter_d.item(reg1.id, reg2.id)
+        return self.interD(reg1, reg2)
+
+    def gridIntraD(self, reg: Region) -> float:
+        if self.__tables is not None and self.__onGrid(reg):
+            return self.__tables.intra_d.item(reg.id)
+        return self.intraD(reg)
+
+    def travelTime(self, reg1: Region, reg2: Region) -> float:
+        if self.__tables is not None and self.__onGrid(reg1) and self.__onGrid(reg2):
+            return self.__tables.inter_d.item(reg1.id, reg2.id) / self.v
+        return self.interD(reg1, reg2) / self.v
+
+    def sensingTime(self, reg: Region) -> float:
+        if self.__tables is not None and self.__onGrid(reg):
+            return self.__tables.sensing_time.item(reg.id)
+        return self.intraD(reg) / self.v
+
     @abstractmethod
     def interD(self, reg1: Region, reg2: Region) -> float:
         """
@@ -78,6 +156,17 @@ class RobotCategory(ABC):
         """
 
 
+def feasibilityMask(robots: List['Robot'], tasks: List[Task]) -> np.ndarray:
+    """
+    mask[i, j]表示robots[i]是否有可以用于tasks[j]的传感器
+    """
+    categories = {r.C.id: r.C for r in robots}
+    rc_index = {rc_id: i for i, rc_id in enumerate(categories)}
+    rc_mask = np.array([[bool(rc.adequateSensors(task)) for task in tasks] for rc in categories.values()],
+                       dtype=bool).reshape(len(categories), len(tasks))
+    return rc_mask[[rc_index[r.C.id] for r in robots]]
+
+
 class Robot:
 
     def __init__(self, rid, r_category, init_reg):
@@ -94,6 +183,8 @@ class Robot:
         self.state = self.idleState
 
         # dynamic location info
+        # 位置索引(spatialIndex.RobotGrid)，加入索引后location的改变会通知索引
+        self.location_index = None
         self.location: Point = self.init_reg.randomLoc()
         self.current_region: Region = init_reg
 
@@ -126,6 +217,22 @@ class Robot:
     def __str__(self):
         return f"Robot({self.id:>2}, {self.C.category:8}, {self.state})"
 
+    def __getstate__(self):
+        # 位置索引属于MASys，复制对象（例如发送到进程池）时不携带
+        state = self.__dict__.copy()
+        state['location_index'] = None
+        return state
+
+    @property
+    def location(self) -> Point:
+        return self.__location
+
+    @location.setter
+    def location(self, loc: Point):
+        self.__location = loc
+        if self.location_index is not None:
+            self.location_index.move(self)
+
     """ robot actions """
 
     def assignTask(self, reg, task, used_sensor):
@@ -151,6 +258,10 @@ class Robot:
     def skipSense(self, time):
         self.state.skipSense(time)
 
+    def insertTask(self, pos, reg, task, used_sensor):
+        # state
+        self.state.insertTask(pos, reg, task, used_sensor)
+
     def broken(self):
         # state
         self.state.broken()
@@ -167,6 +278,21 @@ class Robot:
         self.ideal_sensing_time = self.ideal_sensing_time[:cursor]
         self.planned_distance = self.planned_distance[:cursor]
 
+    def newStartPoint(self, time):
+        """
+        取消计划时以当前区域建立新起点，之后分配的任务从time开始计划
+        """
+        self.planned_path.append(self.current_region)
+        self.finish_time.append(time)  # 起点看为已完成任务，则finish time为当前时间
+        self.task_in_reg.append([None])
+        self.sensor_in_reg.append([None])
+        self.ideal_time_used.append(0)
+        self.ideal_moving_time.append(0)
+        self.ideal_sensing_time.append(0)
+        # 需要更新计划距离
+        dis = self.planned_distance[-1] + self.C.gridInterD(self.planned_path[-2], self.planned_path[-1])
+        self.planned_distance.append(dis)
+
     def canFinishTaskInTime(self, time):
         if self.isFinishMissions:  # 如果已经完成所有任务，则返回True
             return True
@@ -199,12 +325,53 @@ class Robot:
     def distBetweenRobot(self, r: 'Robot'):
         return EuclideanDistance(self.location, r.location)
 
+    @property
+    def insertion_start(self):
+        """
+        可以插入新任务的第一个位置：正在执行的任务之后；已完成所有任务的机器人只能在末尾追加
+        """
+        return len(self.planned_path) if self.isFinishMissions else self.current_cursor + 1
+
+    def insertionEntries(self, pos, reg, task, used_sensor) -> list:
+        """
+        在pos处插入任务后，计划中pos及之后的(reg, tasks, sensors)
+        """
+        return [(reg, [task], [used_sensor])] + list(zip(self.planned_path[pos:],
+                                                         self.task_in_reg[pos:],
+                                                         self.sensor_in_reg[pos:]))
+
+    def replanSuffix(self, pos, entries) -> Optional[PlanSuffix]:
+        """
+        计划中pos及之后的部分替换为entries后的理想计划，不修改机器人
+        :param entries: [(reg, tasks, sensors)]
+        :return: 各项记录中pos及之后的部分；若某一任务无法在其时间范围内完成，返回None
+        """
+        plan = PlanSuffix([], [], [], [], [])
+        prev_reg = self.planned_path[pos - 1]
+        prev_time = self.finish_time[pos - 1]
+        distance = self.planned_distance[pos - 1]
+        for reg, tasks, _ in entries:
+            # 与assignTaskOpr相同：到达后等待所有任务开始，再完成感知
+            arrival_time = prev_time + self.C.travelTime(prev_reg, reg)
+            finish_time = max(arrival_time, max(t.timeRange.s for t in tasks)) + self.C.sensingTime(reg)
+            if any(finish_time not in t.timeRange for t in tasks):
+                return None
+            distance = distance + (self.C.gridInterD(prev_reg, reg) + self.C.gridIntraD(reg))
+            time_used = finish_time - prev_time
+            sensing_time = self.C.sensingTime(reg)
+            plan.planned_distance.append(distance)
+            plan.finish_time.append(finish_time)
+            plan.ideal_time_used.append(time_used)
+            plan.ideal_sensing_time.append(sensing_time)
+            plan.ideal_moving_time.append(time_used - sensing_time)
+            prev_reg, prev_time = reg, finish_time
+        return plan
+
     def possiblePlan(self, reg, task):
         """
         机器人在reg区域执行task的可能_时间点_和使用的传感器
         """
-        adequate_sensors = set(filter(lambda s: task.adequateSensor(s), self.C.sensors))
-        return ((self.idealFinishTime(reg, s, task), s) for s in adequate_sensors)
+        return ((self.idealFinishTime(reg, s, task), s) for s in self.C.adequateSensors(task))
 
     def idealFinishTime(self, reg, sensor: Sensor, task: Task):
         """
@@ -216,7 +383,7 @@ class Robot:
         """
 
         # 因为机器人执行任务的流程一定是从上一区域移动到此区域，之后再完成任务
-        move_time = self.C.interD(self.planned_path[-1], reg) / self.C.v
+        move_time = self.C.travelTime(self.planned_path[-1], reg)
 
         if not self.state == self.sensingState and not self.current_task_region \
                 and (move_time == 0 and sensor not in self.sensor_in_reg[-1]):
@@ -227,10 +394,10 @@ class Robot:
 
         arrival_time = self.finish_time[-1] + move_time
         # 当机器人到达目标地点时，任务尚未开始，此时原地等待直至任务开始。
-        return max(arrival_time, task.timeRange.s) + self.C.intraD(reg) / self.C.v
+        return max(arrival_time, task.timeRange.s) + self.C.sensingTime(reg)
 
     def taskDistance(self, reg: Region):
-        return self.C.interD(self.planned_path[-1], reg) + self.C.intraD(reg)
+        return self.C.gridInterD(self.planned_path[-1], reg) + self.C.gridIntraD(reg)
 
     def moveDistance(self):
         return self.planned_distance[-1]
@@ -1,16 +1,17 @@
-import functools
-import math
-import itertools
 import collections
 import os
 import pickle
+import weakref
 from typing import *
 
 import numpy as np
 
 from senseArea import Region
-from task import TimeSlot
+from task import TimeSlot, TimeCycle
 from robot import RobotCategory, Robot
+from mapKernel import MaternKernel, NeighborhoodIndex
+from gaussianProcess import ExactGP, SparseGP, inducingPoints
+import mapStorage
 from resultDisplay import pltSenseMap
 
 MapPoint = collections.namedtuple("MapPoint", "reg ts rc")
@@ -21,6 +22,35 @@ class SenseMap:
     """
     senseMap[i, j, k]
     i in Reg, j in TimeSlots, k in RobotCategories
+
+    感知图以形状为(reg, ts, rc)的连续数组存储先验prior与后验mu、sigma，
+    senseMap[i, j, k]返回(mu, sigma)；cell(i, j, k)为不做参数检查的快速访问路径。
+
+    gp_mode:
+        "exact":  精确高斯过程，代价随history长度平方增长，适合较小的history_len
+        "sparse": 基于诱导点的近似高斯过程，代价随history长度线性增长，
+                  适合每个更新周期保留成百上千个观测。
+                  精度取决于诱导点相对核长度尺度PHO的疏密（见gaussianProcess.inducingPoints）：
+                  inducing_num为None时诱导点间隔不超过0.75*PHO，观测点处的误差约为exact模式的1.2~1.5倍；
+                  给出较小的inducing_num时诱导点更稀疏、计算更快，但后验均值会过冲，
+                  例如400*24*3的感知图上取240个诱导点时误差约为exact模式的6倍，未观测点的均值偏移可达2
+    update_mode:
+        "global": 每次update重新计算整张感知图的后验
+        "local":  只重新计算与新观测（及与其相关的历史观测）核值大于local_tol的感知点，
+                  其余点的核值可忽略，后验视为不变
+        "lazy":   update只更新高斯过程并递增epoch，感知点的后验在第一次被访问时计算并记录其epoch，
+                  之后的update使所有点一次性失效；每个更新周期结束时才计算一次整张感知图，
+                  以保持与global模式相同的结果
+
+    map_file可以是旧的.mapdata(pickle)或.smap(见mapStorage)，.smap以写时复制的np.memmap打开，
+    多个进程共享同一份先验；dump_format决定每个更新周期结束时写出的格式：
+        "mapdata"/"smap": 写出完整的先验 {dump_times}.mapdata / {dump_times}.smap
+        "delta":          只向dump_path中的增量日志追加本周期修改的感知点，使用完毕后应调用close()
+    kernel_cache为缓存的核列数(每列为整张感知图与一个历史点之间的核)，cache_policy为"lru"或"fifo"；
+    每次update都会访问本周期全部history_len + 1个历史点的列，缓存更小时会被循环淘汰而几乎全部不命中，
+    因此kernel_cache默认为history_len + 1，给出的较小正值也会被提升到该值，0表示不缓存。
+    async_dump为True时，dump在后台线程中完成(见mapStorage.MapWriter)：update只复制一份先验的快照并放入
+    长度为dump_queue的队列，队列满时阻塞；dump_errors记录后台写出的错误，close()等待所有dump完成。
     """
 
     def __init__(self,
@@ -35,30 +65,53 @@ class SenseMap:
                  sigma_noise=0.03,
                  kappa=0.3,
                  map_file=None,
-                 dump_path=None
+                 dump_path=None,
+                 gp_mode="exact",
+                 history_len=10,
+                 inducing_num=None,
+                 update_mode="global",
+                 local_tol=1e-3,
+                 dump_format="mapdata",
+                 async_dump=False,
+                 dump_queue=4,
+                 kernel_cache=None,
+                 cache_policy="lru",
+                 time_cycle: Optional[TimeCycle] = None
                  ):
         self.size = map_size
         self.Regions: List[Region] = regions
         self.grid_size = grid_size
         self.TimeSlots: List[TimeSlot] = time_slots
+        self.time_cycle: TimeCycle = time_cycle if time_cycle is not None else TimeCycle.fromSlots(time_slots)
         self.RobotCategories: List[RobotCategory] = robot_categories
         self.cellNum = self.size[0] * self.size[1] * self.size[2]
 
         self.area_max_dist = (area_size[0] ** 2 + area_size[1] ** 2) ** 0.5
 
+        if dump_format not in ("mapdata", "smap", "delta"):
+            raise ValueError(f"unknown dump format {dump_format}")
         self.dump_path = dump_path
+        self.dump_format = dump_format
         self.dump_times = 0
-        self.__map: Dict[MapPoint, tuple] = {}
+        self.__mu = np.zeros(self.size)
+        self.__sigma = np.zeros(self.size)
         if map_file is None:
-            self.__prior_map: Dict[MapPoint, int] = {
-                MapPoint(i, j, k): 0
-                for i in range(self.size[0])
-                for j in range(self.size[1])
-                for k in range(self.size[2])
-            }
+            self.__prior_map = np.zeros(self.size)
+        elif mapStorage.isMapFile(map_file):
+            # 写时复制：更新周期中对先验的修改不会写回文件，也不影响共享该文件的其他进程
+            self.__prior_map = mapStorage.openMap(map_file, 'c', self.size)
         else:
+            # .mapdata文件为Dict[MapPoint, float]的pickle
+            self.__prior_map = np.zeros(self.size)
             with open(map_file, 'rb') as fp:
-                self.__prior_map = pickle.load(fp)
+                for key, value in pickle.load(fp).items():
+                    self.__prior_map[key] = value
+        self.__delta_log = None
+        if dump_path is not None and dump_format == "delta":
+            self.__delta_log = mapStorage.DeltaLog(dump_path, self.__prior_map, self.grid_size)
+        self.__writer = mapStorage.MapWriter(dump_queue) if async_dump else None
+        # 感知图被回收或解释器退出时同样等待dump完成
+        self.__closer = weakref.finalize(self, SenseMap.__closeDumps, self.__writer, self.__delta_log)
         self.dimension = 3
 
         # plt parameters
@@ -68,10 +121,33 @@ class SenseMap:
         self.PHO = pho
         self.SIGMA_NOISE = sigma_noise
         self.UPDATE_KAPPA = kappa
+        if kernel_cache is None or kernel_cache > 0:
+            kernel_cache = max(kernel_cache or 0, history_len + 1)
+        self.__kernel = MaternKernel(self.Regions, self.TimeSlots, self.RobotCategories,
+                                     self.area_max_dist, self.PHO,
+                                     cache_size=kernel_cache, cache_policy=cache_policy)
+        if gp_mode == "exact":
+            self.__gp = ExactGP(self.__kernel, self.SIGMA_NOISE)
+        elif gp_mode == "sparse":
+            self.__gp = SparseGP(self.__kernel, self.SIGMA_NOISE,
+                                 inducingPoints(self.__kernel, self.grid_size, inducing_num))
+        else:
+            raise ValueError(f"unknown gp mode {gp_mode}")
+        self.gp_mode = gp_mode
+
+        if update_mode not in ("global", "local", "lazy"):
+            raise ValueError(f"unknown update mode {update_mode}")
+        self.update_mode = update_mode
+        self.__neighborhood = NeighborhoodIndex(self.__kernel, local_tol) if update_mode == "local" else None
+        # 后验可能偏离先验的感知点，local模式下新周期的第一次update需要重新计算它们
+        self.__touched = np.ones(self.size, dtype=bool)
+        # 每个感知点的后验对应的epoch，与self.__epoch不同时需要重新计算
+        self.__epoch = 0
+        self.__cell_epoch = np.zeros(self.size, dtype=int)
 
         # updating attribute
         # self.__history_len = int(self.cellNum * 0.8)
-        self.__history_len = 10
+        self.__history_len = history_len
         self.__history: List[Optional[History]] = []
         self.update_times = 0
 
@@ -95,13 +171,43 @@ class SenseMap:
 
     def __getitem__(self, item):
         item = self.__stdKey(item)
-        return self.__map.setdefault(item, (0, 0))
+        if self.__cell_epoch[item] != self.__epoch:
+            self.__refresh(item)
+        return self.__mu[item], self.__sigma[item]
 
     def __setitem__(self, key, value):
         # 当前__setitem__仅在senseMap内调用，且可以保证key的正确性
         # 为了提升效率故取消__stdKey()的调用
         # key = self.__stdKey(key)
-        self.__map[key] = value
+        self.__mu[key], self.__sigma[key] = value
+
+    def cell(self, reg_id: int, ts_id: int, rc_id: int):
+        """
+        不经过__stdKey检查的快速访问，调用者需保证下标为合法的int
+        """
+        if self.__cell_epoch[reg_id, ts_id, rc_id] != self.__epoch:
+            self.__refresh((reg_id, ts_id, rc_id))
+        return self.__mu[reg_id, ts_id, rc_id], self.__sigma[reg_id, ts_id, rc_id]
+
+    @staticmethod
+    def __readOnly(array: np.ndarray) -> np.ndarray:
+        view = array.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def prior(self) -> np.ndarray:
+        return self.__readOnly(self.__prior_map)
+
+    @property
+    def mu(self) -> np.ndarray:
+        self.__refreshStale()
+        return self.__readOnly(self.__mu)
+
+    @property
+    def sigma(self) -> np.ndarray:
+        self.__refreshStale()
+        return self.__readOnly(self.__sigma)
 
     """ sensMap info """
 
@@ -109,25 +215,65 @@ class SenseMap:
     def update_ratio(self):
         return self.update_times / self.cellNum
 
+    @property
+    def kernel_cache_info(self):
+        return self.__kernel.cache.info()
+
     """ senseMap action """
 
     def beginUpdating(self):
         print(" " * 25, "-" * 10, "SenseMap: init", "-" * 10)
-        old_values = self.__prior_map.values()
-        p_range = max(old_values) - min(old_values)
+        p_range = self.__prior_map.max() - self.__prior_map.min()
         if p_range == 0:
             p_range = 1
-        for key in itertools.product(*(range(x) for x in self.size)):
-            key = self.__stdKey(key)
-            robot_category = self.RobotCategories[key.rc]  # todo 优化：简化操作，放在robot类里
-            mu = self.__prior_map[key] / p_range * robot_category.intraD(self.Regions[key.reg]) / robot_category.v
-            sigma = self.__matern(key, key)
-            self[key] = (mu, sigma)
+        self.__sigma[...] = self.__kernel.gridDiag()
+        self.__touched[...] = True
+        self.__cell_epoch[...] = self.__epoch
+        # intra_d[reg, rc]为各类机器人在各区域内的感知距离
+        intra_d = np.array([[rc.intraD(reg) for rc in self.RobotCategories] for reg in self.Regions])
+        v = np.array([rc.v for rc in self.RobotCategories])
+        self.__mu[...] = self.__prior_map / p_range * intra_d[:, None, :] / v
         pltSenseMap(self)
 
     def update(self, reg: Region, rt: float, r: Robot, fatal=False):
+        self.update_batch([(reg, rt, r, fatal)])
+
+    def update_batch(self, observations: Iterable[Tuple[Region, float, Robot, bool]]):
+        """
+        一次加入多个robot的观测，只做一次后验计算。
+        结果与依次调用update相同：若加入过程中history超过长度，则在该处先计算后验并开始新的更新周期。
+        :param observations: (reg, real_time, robot, fatal)的序列
+        """
         print(" " * 25, "-" * 10, "SenseMap: updating", "-" * 10)
-        t_ideal = r.C.intraD(reg) / r.C.v
+        history = [self.__observe(reg, rt, r, fatal) for reg, rt, r, fatal in observations]
+
+        start = 0
+        while start < len(history):
+            # 本周期还能加入的观测数目，加满后触发新周期
+            end = start + self.__history_len + 1 - len(self.__history)
+            chunk = history[start:end]
+            start = end
+
+            # 应先记录history再更加高斯过程
+            self.__history.extend(chunk)
+            self.__gp.extend([key for _, key in chunk],
+                             [r_pref - self.__prior_map[key] for r_pref, key in chunk])
+            if self.update_mode == "local":
+                self.__update_local([key for _, key in chunk])
+            elif self.update_mode == "lazy":
+                self.__epoch += 1
+            else:
+                self.__update_gaussian_process()
+            self.update_times += len(chunk)
+            if not self.update_times % self.plt_times:
+                # pltSenseMap(self)
+                pass
+
+            if len(self.__history) > self.__history_len:
+                self.__new_update_cycle()
+
+    def __observe(self, reg: Region, rt: float, r: Robot, fatal=False) -> History:
+        t_ideal = r.C.sensingTime(reg)
 
         if fatal:
             # r_pref = -10
@@ -146,77 +292,142 @@ class SenseMap:
         # 而robot的real time是从0起的rt秒，因此需要对时间周期长度取余
         # std_real_time = rt % self.time_long
         # 以上功能已经统一到Time类中 --loyx 2021/5/6
+        ts_id = self.time_cycle.slotIndex(rt)
 
-        try:
-            ts = list(itertools.takewhile(lambda time_slot: rt in time_slot, self.TimeSlots))[0]
-        except IndexError:
-            raise ValueError(f"error real time {rt}")
-
-        # 应先记录history再更加高斯过程
-        self.__history.append(History(r_pref, MapPoint(reg.id, ts.id, r.C.id)))
-        self.__update_gaussian_process()
-        self.update_times += 1
-        if not self.update_times % self.plt_times:
-            # pltSenseMap(self)
-            pass
-
-        if len(self.__history) > self.__history_len:
-            self.__new_update_cycle()
+        return History(r_pref, MapPoint(reg.id, ts_id, r.C.id))
 
     def acquireFunction(self, key: tuple, kappa):
-        return self[key][0] + kappa * self[key][1]
+        mu, sigma = self[key]
+        return mu + kappa * sigma
+
+    def acquireBatch(self, regs, tss, rcs, kappa) -> np.ndarray:
+        """
+        acquireFunction的向量化版本
+        :param regs: 区域下标数组，与tss、rcs按numpy规则广播
+        """
+        regs, tss, rcs = np.broadcast_arrays(np.asarray(regs, dtype=int),
+                                             np.asarray(tss, dtype=int),
+                                             np.asarray(rcs, dtype=int))
+        stale = self.__cell_epoch[regs, tss, rcs] != self.__epoch
+        if stale.any():
+            self.__refreshCells(np.unique(np.stack((regs[stale], tss[stale], rcs[stale]), axis=-1), axis=0))
+        return self.__mu[regs, tss, rcs] + kappa * self.__sigma[regs, tss, rcs]
 
     """ utility functions """
 
+    @property
+    def dump_errors(self) -> List[Exception]:
+        return self.__writer.errors if self.__writer is not None else []
+
+    @property
+    def dump_pending(self) -> int:
+        return self.__writer.pending if self.__writer is not None else 0
+
     def dumpMap(self, file_path):
         if not os.path.exists(file_path):
             os.mkdir(file_path)
-        filename = os.path.join(file_path, f"{self.dump_times}.mapdata")
-        with open(filename, 'wb') as fp:
-            pickle.dump(self.__prior_map, fp)
+        # delta格式下的完整dump写为.smap
+        dump_format = "smap" if self.dump_format == "delta" else self.dump_format
+        filename = os.path.join(file_path, f"{self.dump_times}.{dump_format}")
+        if dump_format == "smap":
+            self.__dump(mapStorage.writeMap, filename, self.__snapshot(self.__prior_map), self.grid_size)
+        else:
+            self.__dump(mapStorage.writeMapData, filename, self.__snapshot(self.__prior_map))
         self.dump_times += 1
         print(" " * 25, "-" * 10, "SenseMap: dumpData", "-" * 10)
 
+    def dumpDelta(self, keys):
+        cells = np.unique(np.ravel_multi_index(np.array(keys).T, self.size))
+        # 花式索引得到的values已经是副本
+        self.__dump(self.__delta_log.append, self.dump_times, cells, self.__prior_map.flat[cells])
+        self.dump_times += 1
+
+    def close(self):
+        """
+        等待后台dump完成，并将尚在缓冲区中的dump写入磁盘
+        """
+        self.__closer()
+
+    @staticmethod
+    def __closeDumps(writer, delta_log):
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            if delta_log is not None:
+                delta_log.close()
+
+    def __snapshot(self, array: np.ndarray) -> np.ndarray:
+        # 同步写出时无需复制
+        return np.array(array) if self.__writer is not None else array
+
+    def __dump(self, func, *args):
+        if self.__writer is not None:
+            self.__writer.submit(func, *args)
+        else:
+            func(*args)
+
     def __new_update_cycle(self):
-        for _, key in self.__history:
+        # lazy模式：高斯过程重置前先计算出尚未访问的感知点，与global模式一致
+        self.__refreshStale()
+        keys = [key for _, key in self.__history]
+        for key in keys:
             self.__prior_map[key] = self.acquireFunction(key, self.UPDATE_KAPPA)
         self.__history.clear()
+        self.__gp.reset()
         self.update_times = 0
-        if self.dump_path is not None:
+        if self.__delta_log is not None:
+            self.dumpDelta(keys)
+        elif self.dump_path is not None:
             self.dumpMap(self.dump_path)
 
     def __update_gaussian_process(self):
-        p_diff = np.array([r_perf - self.__prior_map[key] for r_perf, key in self.__history])
-        covariance = [[self.__matern(x.m_point, y.m_point) for x in self.__history] for y in self.__history]
-        cov_k_inv = np.linalg.inv(np.array(covariance) + self.SIGMA_NOISE * np.eye(len(self.__history)))
-        k_inv_p_diff_dot = np.dot(cov_k_inv, p_diff)
-
-        # updating
-        for key in self.__map.keys():
-            k = np.array([self.__matern(key, his.m_point) for his in self.__history])
-
-            mu = self.__prior_map[key] + np.dot(k.T, k_inv_p_diff_dot)
-            sigma = self.__matern(key, key) - np.dot(np.dot(k.T, cov_k_inv), k)
-            self[key] = (mu, sigma)
-
-    def __getObj(self, key: MapPoint):
-        return self.Regions[key.reg], self.TimeSlots[key.ts], self.RobotCategories[key.rc]
-
-    # 注意：lru_cache需要足够大才能优化性能
-    @functools.lru_cache(None, False)
-    def __matern(self, p1: MapPoint, p2: MapPoint):
-        factor = (1, 1, 1)
-        reg1, ts1, rc1 = self.Regions[p1.reg], self.TimeSlots[p1.ts], self.RobotCategories[p1.rc]
-        reg2, ts2, rc2 = self.Regions[p2.reg], self.TimeSlots[p2.ts], self.RobotCategories[p2.rc]
-        d = factor[0] / sum(factor) * reg1.dist(reg2) / self.area_max_dist \
-            + factor[1] / sum(factor) * ts1.dist(ts2, len(self.TimeSlots)) / len(self.TimeSlots) \
-            + factor[2] / sum(factor) * rc1.dissimilarity(rc2)
-        # d = d / 32
-        if d > 1:
-            d = 1
-        assert 0 <= d <= 1
-        return (1 + 2.236067977 * d / self.PHO + 5 * d * d / (3 * self.PHO * self.PHO)) * math.exp(
-            -2.236067977 * d / self.PHO)
+        # 高斯过程已在加入history时增量更新，此处只需计算后验
+        mean, var = self.__gp.predictGrid()
+        self.__mu[...] = self.__prior_map + mean
+        self.__sigma[...] = var
+
+    def __refresh(self, key):
+        mean, var = self.__gp.predict([key])
+        self.__mu[key] = self.__prior_map[key] + mean[0]
+        self.__sigma[key] = var[0]
+        self.__cell_epoch[key] = self.__epoch
+
+    def __refreshCells(self, keys: np.ndarray):
+        mean, var = self.__gp.predict(keys)
+        i, j, k = keys.T
+        self.__mu[i, j, k] = self.__prior_map[i, j, k] + mean
+        self.__sigma[i, j, k] = var
+        self.__cell_epoch[i, j, k] = self.__epoch
+
+    def __refreshStale(self):
+        stale = self.__cell_epoch != self.__epoch
+        if stale.all():
+            # 整张感知图失效（lazy模式下update之后尚未访问任何点）时与global模式相同，可以利用核缓存
+            self.__update_gaussian_process()
+            self.__cell_epoch[...] = self.__epoch
+        elif stale.any():
+            mean, var = self.__gp.predict(np.argwhere(stale))
+            self.__mu[stale] = self.__prior_map[stale] + mean
+            self.__sigma[stale] = var
+            self.__cell_epoch[stale] = self.__epoch
+
+    def __update_local(self, m_points: List[MapPoint]):
+        # 新观测会改变与之相关的历史观测的权重，因此需要一并更新这些历史观测的近邻
+        history = np.array([key for _, key in self.__history])
+        related = history[(self.__kernel.block(m_points, history) > self.__neighborhood.tol).any(axis=0)]
+        affected = self.__neighborhood.mask(np.vstack((related, m_points)), self.size)
+
+        # 新周期的第一次update：上一周期更新过的点需要回到新的先验
+        if len(self.__history) == len(m_points):
+            affected |= self.__touched
+            self.__touched = affected.copy()
+        else:
+            self.__touched |= affected
+
+        mean, var = self.__gp.predict(np.argwhere(affected))
+        self.__mu[affected] = self.__prior_map[affected] + mean
+        self.__sigma[affected] = var
 
 
 class MapCreator:
@@ -29,7 +29,8 @@ class Event:
 
 
 def physicalRobot(robot: Robot, start_time=0):
-    assert robot.state == robot.idleState
+    # MASys继续中断的任务分配时，robot在重建协程之前就已启动，此时处于MovingState
+    assert robot.state == robot.idleState or robot.state == robot.movingState
     # robot 预激后，由MASys负责分配任务，并启动所有robot
     # 因而下一个yield时，robot的状态应该为MovingState
     time = yield Event(start_time, robot, "init")
@@ -149,6 +150,11 @@ class Simulator:
                 else:
                     # self.events.put(next_event)
                     heapq.heappush(self.events, next_event)
+
+                # MASys继续中断的任务分配后，已完成所有任务、又被分配了任务的robot需要重建协程
+                for r in feed_back.robots or ():
+                    self.__removeEvent(r)
+                    self.__startRobot(r, sim_time)
             elif feed_back.status_code == 1:  # 自修复操作
                 need_repair_robots: List[Robot] = feed_back.robots
 
@@ -157,24 +163,14 @@ class Simulator:
                     # 当robot处于sensingState时，证明这是一次热自修复，不需要删除events
                     if r.state == r.sensingState:
                         continue
-                    for index, event in enumerate(self.events):
-                        # 这里必须使用id判断相等，因为一个robot被多个对象引用
-                        if r == event.robot:
-                            del self.events[index]
-                            # 因为每一个robot有且只有一个event，所以此处break
-                            # 注意一般不能边迭代边del，这里是特殊情况
-                            # todo 优化：更优的方式是将其赋值为一个nonsense event
-                            break
+                    self.__removeEvent(r)
 
                 # 构建新的robot协程，并更新记录和预激
                 for r in need_repair_robots:
                     # 当robot处于sensingState时，证明这是一次热自修复，不需要重建协程
                     if r.state == r.sensingState:
                         continue
-                    p_robot = physicalRobot(r, sim_time)
-                    self.p_robots[r.id] = p_robot
-                    first_event = next(p_robot)
-                    heapq.heappush(self.events, first_event)
+                    self.__startRobot(r, sim_time)
 
                 # 恢复MASys的自修复部分
                 next(sim_sys)
@@ -182,6 +178,25 @@ class Simulator:
         else:
             print(f"*** end of simulation time: {len(self.events)} events pending ***")
 
+        # 写出感知图尚未落盘的dump
+        self.MASys.senseMap.close()
+
+    def __removeEvent(self, robot):
+        for index, event in enumerate(self.events):
+            # 这里必须使用id判断相等，因为一个robot被多个对象引用
+            if robot == event.robot:
+                del self.events[index]
+                # 因为每一个robot有且只有一个event，所以此处break
+                # 注意一般不能边迭代边del，这里是特殊情况
+                # todo 优化：更优的方式是将其赋值为一个nonsense event
+                break
+
+    def __startRobot(self, robot, sim_time):
+        # 构建新的robot协程，并更新记录和预激
+        p_robot = physicalRobot(robot, sim_time)
+        self.p_robots[robot.id] = p_robot
+        heapq.heappush(self.events, next(p_robot))
+
 
 if __name__ == '__main__':
     pass
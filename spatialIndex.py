@@ -0,0 +1,123 @@
+import heapq
+from typing import Callable, Dict, List, Optional, Tuple
+
+from senseArea import SenseArea, Point, EuclideanDistance
+
+
+class RobotGrid:
+    """
+    机器人位置的均匀网格索引，网格与SenseArea.grid(granularity)的区域一致。
+    每个格子保存位于其中的机器人，机器人的location改变时由Robot通知索引更新所在格子。
+    k近邻与半径查询从查询点所在的格子开始逐环向外扩展，只检查可能包含结果的格子；
+    结果按(距离, robot.id)排序，距离与Robot.distBetweenRobot相同。
+    """
+
+    def __init__(self, sense_area: SenseArea, granularity):
+        self.origin = sense_area.startPoint
+        self.granularity = granularity
+        self.shape = tuple(max(1, int(x // granularity)) for x in sense_area.len)
+        # 格子 -> {robot.id: robot}
+        self.__cells: Dict[Tuple[int, int], Dict[int, 'Robot']] = {}
+        # robot.id -> 格子
+        self.__where: Dict[int, Tuple[int, int]] = {}
+
+    def __len__(self):
+        return len(self.__where)
+
+    def __contains__(self, robot):
+        return robot.id in self.__where
+
+    def cellOf(self, point: Point) -> Tuple[int, int]:
+        # 感知区域边界上的点归入最近的格子
+        return tuple(min(max(int((p - o) // self.granularity), 0), n - 1)
+                     for p, o, n in zip(point, self.origin, self.shape))
+
+    def insert(self, robot):
+        """
+        加入索引，之后robot.location的改变会自动更新索引
+        """
+        if robot in self:
+            raise ValueError(f"Robot{robot.id} is already in the index")
+        robot.location_index = self
+        self.move(robot)
+
+    def remove(self, robot):
+        cell = self.__where.pop(robot.id)
+        del self.__cells[cell][robot.id]
+        if not self.__cells[cell]:
+            del self.__cells[cell]
+        robot.location_index = None
+
+    def move(self, robot):
+        """
+        robot的位置改变后更新其所在格子
+        """
+        cell = self.cellOf(robot.location)
+        old = self.__where.get(robot.id)
+        if old == cell:
+            return
+        if old is not None:
+            del self.__cells[old][robot.id]
+            if not self.__cells[old]:
+                del self.__cells[old]
+        self.__cells.setdefault(cell, {})[robot.id] = robot
+        self.__where[robot.id] = cell
+
+    """ queries """
+
+    def nearest(self, point: Point, k, predicate: Optional[Callable] = None) -> List['Robot']:
+        """
+        距离point最近的k个机器人
+        :param predicate: 只考虑predicate(robot)为真的机器人
+        """
+        if k <= 0:
+            return []
+        found = []
+        for ring, robots in self.__rings(point):
+            for robot in robots:
+                if predicate is None or predicate(robot):
+                    found.append((EuclideanDistance(point, robot.location), robot.id, robot))
+            # 之后的环与point的距离不小于ring * granularity，第k近的机器人更近时即可停止
+            if len(found) >= k and heapq.nsmallest(k, found)[-1][0] < ring * self.granularity:
+                break
+        return [robot for _, _, robot in heapq.nsmallest(k, found)]
+
+    def within(self, point: Point, radius, predicate: Optional[Callable] = None) -> List['Robot']:
+        """
+        与point的距离不超过radius的机器人
+        :param predicate: 只考虑predicate(robot)为真的机器人
+        """
+        found = []
+        for ring, robots in self.__rings(point):
+            # 第ring环与point的距离不小于(ring - 1) * granularity
+            if (ring - 1) * self.granularity > radius:
+                break
+            for robot in robots:
+                if predicate is None or predicate(robot):
+                    dist = EuclideanDistance(point, robot.location)
+                    if dist <= radius:
+                        found.append((dist, robot.id, robot))
+        return [robot for _, _, robot in sorted(found)]
+
+    def __rings(self, point: Point):
+        """
+        从point所在格子开始，逐环（切比雪夫距离）生成(环序号, 环内格子中的机器人)，直至覆盖整个网格
+        """
+        ci, cj = self.cellOf(point)
+        max_ring = max(ci, cj, self.shape[0] - 1 - ci, self.shape[1] - 1 - cj)
+        for ring in range(max_ring + 1):
+            robots = []
+            for i, j in self.__ring(ci, cj, ring):
+                robots.extend(self.__cells.get((i, j), {}).values())
+            yield ring, robots
+
+    def __ring(self, ci, cj, ring):
+        if ring == 0:
+            return [(ci, cj)]
+        cells = []
+        for i in range(ci - ring, ci + ring + 1):
+            if not 0 <= i < self.shape[0]:
+                continue
+            js = (cj - ring, cj + ring) if abs(i - ci) != ring else range(cj - ring, cj + ring + 1)
+            cells.extend((i, j) for j in js if 0 <= j < self.shape[1])
+        return cells
@@ -2,6 +2,8 @@ import functools
 from abc import ABC
 from typing import List, Dict
 
+import numpy as np
+
 from senseArea import Area, Region
 from sensor import Sensor
 
@@ -43,13 +45,18 @@ class TimeSlot(TimeBase):
 
 class TimeCycle(TimeBase):
 
-    def __init__(self, cycle_len):
+    def __init__(self, cycle_len, time_granularity=None):
         super().__init__(0, cycle_len)
         self.cycle_length = cycle_len
+        self.granularity = time_granularity
 
     def __repr__(self):
         return f"TimeCycle({self.cycle_length})"
 
+    @classmethod
+    def fromSlots(cls, time_slots: List[TimeSlot]) -> 'TimeCycle':
+        return cls(time_slots[0].cycle_length, time_slots[0].len)
+
     def discretize(self, time_granularity: int) -> List[TimeSlot]:
         if self.len % time_granularity:
             raise ValueError("granularity should be factor of length")
@@ -59,6 +66,19 @@ class TimeCycle(TimeBase):
             for i in range(self.len // time_granularity)
         ]
 
+    def slotIndex(self, time) -> int:
+        """
+        时间点所在TimeSlot的id，与discretize(granularity)得到的TimeSlot一致
+        granularity只由构造函数或fromSlots给出，discretize不会修改它
+        """
+        return int(time % self.cycle_length // self.granularity)
+
+    def slotIndices(self, times) -> np.ndarray:
+        """
+        slotIndex的向量化版本
+        """
+        return (np.asarray(times) % self.cycle_length // self.granularity).astype(int)
+
 
 class TimeRange(TimeBase):
 
@@ -128,6 +148,10 @@ class Task:
         if time > self.timeRange.e:
             self.alive = False
 
+    @property
+    def requiredSensor(self) -> Sensor:
+        return self.__required_sensor
+
     def adequateSensor(self, sensor: Sensor):
         return sensor.category == self.__required_sensor.category  \
                and sensor.accuracy >= self.__required_sensor.accuracy
@@ -0,0 +1,80 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from concreteRobot import UAV, UV, Worker
+from gaussianProcess import ExactGP, SparseGP, inducingPoints
+from mapKernel import MaternKernel
+from senseArea import SenseArea
+from sensor import Sensor
+from task import TimeCycle
+
+NOISE = 0.03
+
+
+def makeKernel(area, ts_num):
+    sense_area = SenseArea((0, 0), (area, area))
+    _, regions = sense_area.grid(10)
+    time_slots = TimeCycle(ts_num * 100).discretize(100)
+    sensor = Sensor(0, "camera", 1, "px", 1, "m")
+    categories = [UAV(0, "uav", [sensor], 10, {"w": 1}),
+                  UV(1, "uv", [sensor], 6, {"w": 2}),
+                  Worker(2, "worker", [sensor], 3, {"w": 3})]
+    kernel = MaternKernel(regions, time_slots, categories, (2 * area ** 2) ** 0.5, 0.05)
+    points = np.array(list(itertools.product(range(len(regions)), range(ts_num), range(len(categories)))))
+    return kernel, points
+
+
+def observe(gp, points, num, seed=0):
+    rng = np.random.default_rng(seed)
+    observed = points[rng.choice(len(points), num, replace=False)]
+    gp.extend(observed, rng.uniform(0, 1, num))
+    return gp
+
+
+@pytest.mark.parametrize("area, ts_num, tol", [(30, 2, 1e-8), (40, 3, 0.05)])
+def test_sparse_matches_exact_with_all_points_inducing(area, ts_num, tol):
+    # 3x3网格上K半正定，DTC与精确高斯过程相同；4x4网格上K有负特征值，截断后仍应接近
+    kernel, points = makeKernel(area, ts_num)
+    exact_mean, exact_var = observe(ExactGP(kernel, NOISE), points, 10).predictGrid()
+    sparse = observe(SparseGP(kernel, NOISE, points), points, 10)
+    sparse_mean, sparse_var = sparse.predictGrid()
+    assert np.abs(exact_mean - sparse_mean).max() < tol
+    assert np.abs(exact_var - sparse_var).max() < tol
+    point_mean, point_var = sparse.predict(points)
+    assert np.allclose(point_mean, sparse_mean.reshape(-1)) and np.allclose(point_var, sparse_var.reshape(-1))
+
+
+def test_sparse_predict_in_chunks(monkeypatch):
+    kernel, points = makeKernel(30, 2)
+    sparse = observe(SparseGP(kernel, NOISE, points), points, 10)
+    mean, var = sparse.predict(points)
+    monkeypatch.setattr(SparseGP, "CHUNK", 5 * len(points))
+    chunk_mean, chunk_var = sparse.predict(points)
+    assert np.allclose(mean, chunk_mean) and np.allclose(var, chunk_var)
+
+
+def test_default_inducing_points_track_exact():
+    # 20x20网格、24个时间段上默认诱导点的K_mm不半正定，观测点处的误差应与精确高斯过程相当，未观测点不应过冲
+    kernel, points = makeKernel(200, 24)
+    inducing = inducingPoints(kernel, (20, 20))
+    assert np.linalg.eigvalsh(kernel.block(inducing, inducing)).min() < 0
+
+    rng = np.random.default_rng(0)
+    observed = rng.choice(len(points), 50, replace=False)
+    ys = rng.uniform(0, 1, 50)
+    exact, sparse = ExactGP(kernel, NOISE), SparseGP(kernel, NOISE, inducing)
+    exact.extend(points[observed], ys)
+    sparse.extend(points[observed], ys)
+
+    def rmse(gp):
+        return np.sqrt(np.mean((gp.predict(points[observed])[0] - ys) ** 2))
+    assert rmse(sparse) < 1.6 * rmse(exact)
+
+    cells = points[np.unique(np.concatenate((observed, rng.choice(len(points), 2000, replace=False))))]
+    exact_mean, _ = exact.predict(cells)
+    sparse_mean, sparse_var = sparse.predict(cells)
+    assert np.abs(sparse_mean).max() < 1.25 * np.abs(exact_mean).max()
+    assert np.sqrt(np.mean((sparse_mean - exact_mean) ** 2)) < 0.1
+    assert np.all(sparse_var >= 0) and np.all(sparse_var <= kernel.diag(cells) + 1e-12)